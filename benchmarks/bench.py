@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the power and expect paths of lab-controller.py against
+# simulated hardware: pty pairs stand in for the relay board and the
+# consoles, and a fake uhubctl script for the usb hubs.
+
+import os
+import sys
+import argparse
+import importlib.util
+import json
+import pty
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tty
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+
+def load_lab_controller():
+  spec = importlib.util.spec_from_file_location("lab_controller", os.path.join(this_dir, "..", "lab-controller.py"))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+class FakeRelayBoard(object):
+  """Answers the relay board protocol on the master side of a pty."""
+  def __init__(self):
+    self.master, self.slave = pty.openpty()
+    tty.setraw(self.master)
+    self.device = os.ttyname(self.slave)
+    self.commands = 0
+    threading.Thread(target = self.serve, daemon = True).start()
+
+  def serve(self):
+    pending = b''
+    while True:
+      try:
+        pending += os.read(self.master, 1024)
+      except OSError:
+        return
+      while b'\r' in pending:
+        line, pending = pending.split(b'\r', 1)
+        self.commands += 1
+        if line == b'':
+          os.write(self.master, b'Welcome. Commands available are RELAY<N>:ON RELAY<N>:OFF\r\n')
+        else:
+          os.write(self.master, b'Success: ' + line + b'\r\n')
+
+class FakeConsole(object):
+  """Prints a verbose boot log followed by a login prompt whenever it receives a line."""
+  def __init__(self, boot_lines):
+    self.master, self.slave = pty.openpty()
+    tty.setraw(self.master)
+    self.device = os.ttyname(self.slave)
+    self.boot_log = b''.join(b'[%8d.%06d] kernel: verbose boot message number %d with padding\r\n' % (i, i, i)
+      for i in range(boot_lines)) + b'\r\nlab login: '
+    threading.Thread(target = self.serve, daemon = True).start()
+
+  def serve(self):
+    while True:
+      try:
+        data = os.read(self.master, 1024)
+      except OSError:
+        return
+      if b'\r' in data:
+        view = memoryview(self.boot_log)
+        while view:
+          written = os.write(self.master, view[:4096])
+          view = view[written:]
+
+FAKE_UHUBCTL = """#!/bin/bash
+while getopts "a:l:p:" option; do
+  case $option in
+    a) action=$OPTARG;;
+    l) location=$OPTARG;;
+    p) port=$OPTARG;;
+  esac
+done
+echo "Current status for hub $location [2109:2811 USB2.0 Hub, USB 2.10, 4 ports]"
+echo "  Port $port: 0503 power highspeed enable connect [0424:ec00]"
+echo "Sent power $action request"
+echo "New status for hub $location [2109:2811 USB2.0 Hub, USB 2.10, 4 ports]"
+if [ "$action" = "off" ]; then
+  echo "  Port $port: 0000 off"
+else
+  echo "  Port $port: 0100 power"
+fi
+"""
+
+def build_fake_sysfs(sysfs_root, usb_address, ports):
+  interface_path = os.path.join(sysfs_root, "bus", "usb", "devices", "{}:1.0".format(usb_address))
+  for port in ports:
+    port_path = os.path.join(interface_path, "{}-port{}".format(usb_address, port))
+    os.makedirs(port_path)
+    with open(os.path.join(port_path, "disable"), 'w') as disable:
+      disable.write("0\n")
+
+def relay_appliance(device, relay):
+  def io(command):
+    return [{"io" : [
+      {"send" : "\r", "expect" : {"text" : "Welcome. Commands available are", "timeout" : "2"}},
+      {"send" : "RELAY{}:{}\r".format(relay, command),
+        "expect" : {"text" : "Success: RELAY{}:{}".format(relay, command), "timeout" : "2"}}]}]
+  return {"power" : [{"type" : "serial", "baud" : "115200", "device" : device,
+    "command" : {"on" : io("ON"), "off" : io("OFF")}}]}
+
+def usb_appliance(port):
+  return {"power" : [{"type" : "usb", "usb-address" : "1-2.3", "usb-port" : str(port)}]}
+
+def host_appliance():
+  return {"power" : [{"type" : "host", "command" : {"on" : [{"execute" : "true"}], "off" : [{"execute" : "true"}]}}]}
+
+def build_config(relay_board, console, group_size):
+  json_conf = {}
+  for relay in range(8):
+    json_conf["relay-{}".format(relay)] = relay_appliance(relay_board.device, relay)
+  for port in range(1, 5):
+    json_conf["usb-{}".format(port)] = usb_appliance(port)
+  for index in range(group_size):
+    json_conf["host-{}".format(index)] = host_appliance()
+
+  json_conf["relays"] = {"power" : [{"type" : "group", "devices" : ["relay-{}".format(r) for r in range(8)]}]}
+  json_conf["hub"] = {"power" : [{"type" : "group", "devices" : ["usb-{}".format(p) for p in range(1, 5)]}]}
+  json_conf["large-group"] = {"power" : [{"type" : "group",
+    "devices" : ["host-{}".format(i) for i in range(group_size)]}]}
+  json_conf["rig"] = {"power" : [{"type" : "group", "devices" : ["relays", "hub", "large-group"]}]}
+  json_conf["console"] = {"power" : [], "communications" : [{"type" : "serial", "baud" : "115200",
+    "device" : console.device, "reset-prompt" : "\r"}]}
+  return json_conf
+
+def measure(iterations, function):
+  samples = []
+  for _ in range(iterations):
+    start = time.perf_counter()
+    function()
+    samples.append(time.perf_counter() - start)
+  samples.sort()
+  return {"iterations" : iterations, "mean" : statistics.mean(samples), "median" : statistics.median(samples),
+    "p95" : samples[min(len(samples) - 1, int(len(samples) * 0.95))], "min" : samples[0], "max" : samples[-1]}
+
+def run_benchmarks(lab_controller, iterations, boot_lines, group_size, log_directory):
+  relay_board = FakeRelayBoard()
+  console = FakeConsole(boot_lines)
+  config = lab_controller.compile_config(build_config(relay_board, console, group_size))
+  if config.errors:
+    raise RuntimeError('\n'.join(config.errors))
+
+  def power(appliance, action, jobs = 1):
+    lab_controller.do_power(appliance, action, config, log_directory, None, lab_controller.PowerRun(jobs))
+
+  expects = {"expect" : [
+    {"text" : "verbose boot message number {} ".format(boot_lines // 4), "timeout" : "30"},
+    {"text" : "verbose boot message number {} ".format(boot_lines // 2), "timeout" : "30"},
+    {"text" : "login: ", "timeout" : "30"}]}
+
+  results = {}
+  results["power-serial-single"] = measure(iterations, lambda: power("relay-0", "on"))
+  results["power-serial-8-relays"] = measure(iterations, lambda: power("relays", "on"))
+  lab_controller.usb_settings.backend = "uhubctl"
+  results["power-usb-single"] = measure(iterations, lambda: power("usb-1", "off"))
+  results["power-usb-4-ports"] = measure(iterations, lambda: power("hub", "on"))
+  lab_controller.usb_settings.backend = "sysfs"
+  lab_controller.usb_settings.sysfs_root = os.path.join(log_directory, "sys")
+  build_fake_sysfs(lab_controller.usb_settings.sysfs_root, "1-2.3", range(1, 5))
+  results["power-usb-single-sysfs"] = measure(iterations, lambda: power("usb-1", "off"))
+  results["power-usb-4-ports-sysfs"] = measure(iterations, lambda: power("hub", "on"))
+  lab_controller.usb_settings.backend = "uhubctl"
+  results["power-group-{}-sequential".format(group_size)] = measure(iterations, lambda: power("large-group", "on"))
+  results["power-group-{}-parallel".format(group_size)] = measure(iterations,
+    lambda: power("large-group", "on", jobs = 8))
+  results["power-rig-parallel"] = measure(iterations, lambda: power("rig", "on", jobs = 8))
+  results["expect-on-serial-chatty"] = measure(iterations,
+    lambda: lab_controller.expect_on_serial("console", expects, config, log_directory = log_directory))
+  results["expect-on-serial-chatty"]["bytes"] = len(console.boot_log)
+  results["expect-on-serial-chatty"]["throughput-mb-s"] = \
+    len(console.boot_log) / results["expect-on-serial-chatty"]["median"] / 1e6
+  return results
+
+def get_revision():
+  try:
+    return subprocess.check_output(["git", "-C", this_dir, "rev-parse", "--short", "HEAD"],
+      stderr = subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return "unknown"
+
+def print_results(results, baseline = None):
+  print("{:<32} {:>10} {:>10} {:>10} {:>10}".format("Benchmark", "Median (s)", "p95 (s)", "Max (s)",
+    "vs base"))
+  for name, result in results.items():
+    delta = ""
+    if baseline and name in baseline:
+      delta = "{:+.1f}%".format((result["median"] / baseline[name]["median"] - 1) * 100)
+    print("{:<32} {:>10.4f} {:>10.4f} {:>10.4f} {:>10}".format(name, result["median"], result["p95"],
+      result["max"], delta))
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks lab-controller against simulated serial and usb hardware.")
+  parser.add_argument("-n", "--iterations", type = int, default = 10)
+  parser.add_argument("--boot-lines", type = int, default = 20000,
+    help = "Number of kernel log lines the simulated console prints before its login prompt")
+  parser.add_argument("--group-size", type = int, default = 32)
+  parser.add_argument("-o", "--output", help = "Write the results as json, to compare across commits")
+  parser.add_argument("--compare", help = "A json file from a previous --output to compare against")
+  args = parser.parse_args()
+
+  work_directory = tempfile.mkdtemp(prefix = "lab-controller-bench-")
+  try:
+    bin_directory = os.path.join(work_directory, "bin")
+    os.mkdir(bin_directory)
+    with open(os.path.join(bin_directory, "uhubctl"), 'w') as uhubctl:
+      uhubctl.write(FAKE_UHUBCTL)
+    os.chmod(os.path.join(bin_directory, "uhubctl"), 0o755)
+    os.environ["PATH"] = bin_directory + os.pathsep + os.environ["PATH"]
+    # Keep the step timings, device index and lease files of the runs out of the real ones.
+    os.environ["LAB_CONTROLLER_CACHE_DIR"] = os.path.join(work_directory, "cache")
+    os.environ["LAB_CONTROLLER_LEASE_DIR"] = os.path.join(work_directory, "leases")
+
+    lab_controller = load_lab_controller()
+    lab_controller.log_settings.echo = False
+    # The power paths print progress; keep the report readable.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+      results = run_benchmarks(lab_controller, args.iterations, args.boot_lines, args.group_size, work_directory)
+    finally:
+      lab_controller.timing_history.save()
+      sys.stdout.close()
+      sys.stdout = stdout
+  finally:
+    shutil.rmtree(work_directory)
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)["results"]
+  print_results(results, baseline)
+
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump({"revision" : get_revision(), "time" : time.time(), "results" : results}, output, indent = 2)
+
+if __name__ == '__main__':
+  main()
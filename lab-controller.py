@@ -5,36 +5,616 @@ import sys
 import argparse
 import json
 import pexpect
+import pexpect.fdpexpect
+import termios
+import fcntl
+import mmap
+import select
+import codecs
+import atexit
+import contextlib
+import hashlib
+import hmac
+import binascii
+import pickle
+import tempfile
+import subprocess
 import time
+import random
+import re
+import collections
+import threading
+import concurrent.futures
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+import queue
+import gzip
+import shutil
+import socket
+import stat
+import socketserver
+import signal
+
+class LogSettings(object):
+  def __init__(self):
+    self.buffer_size = 64 * 1024
+    self.compression = None
+    self.echo = os.environ.get("LAB_CONTROLLER_NO_ECHO", "") == ""
+
+log_settings = LogSettings()
+
+class LogWriter(threading.Thread):
+  """Writes the data of every open Tee from a single background thread."""
+  def __init__(self):
+    threading.Thread.__init__(self, name = "lab-controller-log-writer", daemon = True)
+    self.queue = queue.Queue()
+    self.open_tees = set()
+
+  def run(self):
+    while True:
+      try:
+        tee, data = self.queue.get(timeout = 1)
+      except queue.Empty:
+        # Idle: make what was written so far visible in the log files.
+        for tee in list(self.open_tees):
+          self.handle(tee, tee.file.flush)
+        continue
+
+      if tee.closed.is_set():
+        # The log failed earlier: drop what was still queued for it.
+        continue
+      if data is None:
+        self.open_tees.discard(tee)
+        self.handle(tee, tee.finish)
+        continue
+
+      self.open_tees.add(tee)
+      if self.handle(tee, lambda: tee.file.write(data)) and tee.echo:
+        sys.stdout.write(data)
+
+  def handle(self, tee, operation):
+    """Runs a file operation of tee. A failure ends that log, not the writer of every log."""
+    try:
+      operation()
+      return True
+    except Exception as e:
+      print("Log file {} failed: {}".format(tee.name, e))
+      self.open_tees.discard(tee)
+      try:
+        tee.file.close()
+      except Exception:
+        pass
+      tee.closed.set()
+      return False
+
+log_writer = None
+log_writer_lock = threading.Lock()
+
+def get_log_writer():
+  global log_writer
+  with log_writer_lock:
+    if log_writer is None:
+      log_writer = LogWriter()
+      log_writer.start()
+    return log_writer
+
+def compress_log(name, compression):
+  if compression == "gzip":
+    with open(name, 'rb') as source, gzip.open(name + ".gz", 'wb') as target:
+      shutil.copyfileobj(source, target)
+    os.unlink(name)
+    return name + ".gz"
+  elif compression == "zstd":
+    with open(name, 'rb') as source, open(name + ".zst", 'wb') as target:
+      zstandard.ZstdCompressor().copy_stream(source, target)
+    os.unlink(name)
+    return name + ".zst"
+  return name
 
 class Tee(object):
-  def __init__(self, name, mode):
+  """Log file that also echoes to stdout. Writes happen in the background LogWriter."""
+  def __init__(self, name, mode, echo = None, listener = None):
     self.name = name
-    self.file = open(name, mode)
-    self.stdout = sys.stdout
+    self.file = open(name, mode, buffering = log_settings.buffer_size)
+    self.echo = log_settings.echo if echo is None else echo
+    self.listener = listener
+    self.compression = log_settings.compression
+    self.closed = threading.Event()
+    self.writer = get_log_writer()
     print("Log file in {}".format(name))
-  def __del__(self):
-    self.file.close()
-    print("Closed Log file in {}".format(self.name))
+  def __enter__(self):
+    return self
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
   def write(self, data):
-    self.file.write(data)
-    self.stdout.write(data)
+    if not self.closed.is_set():
+      self.writer.queue.put((self, data))
+      if self.listener is not None:
+        self.listener(data)
   def flush(self):
-    self.file.flush()
+    # Called by pexpect after every chunk. The writer flushes when idle and on close.
+    pass
+  def close(self):
+    if not self.closed.is_set():
+      self.writer.queue.put((self, None))
+      self.closed.wait()
+  def finish(self):
+    self.file.close()
+    try:
+      self.name = compress_log(self.name, self.compression)
+    except OSError as e:
+      print("Could not compress {}: {}".format(self.name, e))
+    print("Closed Log file in {}".format(self.name))
+    self.closed.set()
+
+class Tracer(object):
+  """Records timed spans of the power and expect steps of a run when enabled."""
+  def __init__(self):
+    self.enabled = False
+    self.start = time.time()
+    self.events = []
+    self.lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def span(self, name, **args):
+    """Times the enclosed block. Steps may add results to the yielded args."""
+    if not self.enabled:
+      yield args
+      return
+
+    start = time.time()
+    try:
+      yield args
+    except Exception as e:
+      args["error"] = str(e).split("\n")[0]
+      raise
+    finally:
+      event = {"name" : name, "start" : start - self.start, "duration" : time.time() - start,
+        "thread" : threading.current_thread().name, "args" : args}
+      with self.lock:
+        self.events.append(event)
+
+  def write(self, path):
+    with self.lock:
+      events = sorted(self.events, key = lambda event: event["start"])
+    with open(path, 'w') as trace_file:
+      if path.endswith(".json"):
+        threads = {}
+        trace_events = [{"name" : event["name"], "ph" : "X", "pid" : os.getpid(),
+          "tid" : threads.setdefault(event["thread"], len(threads)),
+          "ts" : int(event["start"] * 1e6), "dur" : int(event["duration"] * 1e6),
+          "args" : event["args"]} for event in events]
+        json.dump({"traceEvents" : trace_events, "displayTimeUnit" : "ms"}, trace_file, default = str)
+      else:
+        for event in events:
+          trace_file.write(json.dumps(event, default = str) + "\n")
+    print("Trace written to {}".format(path))
+
+  def print_summary(self):
+    summary = collections.OrderedDict()
+    with self.lock:
+      for event in self.events:
+        summary.setdefault(event["name"], []).append(event["duration"])
+
+    print("{:<20} {:>7} {:>11} {:>10} {:>10}".format("Step", "Count", "Total (s)", "Mean (s)", "Max (s)"))
+    for name, durations in summary.items():
+      print("{:<20} {:>7} {:>11.3f} {:>10.3f} {:>10.3f}".format(name, len(durations), sum(durations),
+        sum(durations) / len(durations), max(durations)))
+
+tracer = Tracer()
+
+def get_step_key(step_type, action, json_step):
+  """Identifies a power step across runs by its configuration."""
+  digest = hashlib.sha1(json.dumps(json_step, sort_keys = True).encode('utf-8')).hexdigest()[:16]
+  return "{}:{}:{}".format(step_type, action, digest)
+
+class TimingHistory(object):
+  """Durations of the power steps of past runs, used to estimate --plan."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.history = None
+
+  def get_path(self):
+    return os.path.join(get_cache_directory(), "timings.json")
+
+  def record(self, key, duration):
+    with self.lock:
+      self.pending.setdefault(key, []).append(duration)
+
+  def load(self):
+    try:
+      with open(self.get_path()) as history_file:
+        return json.load(history_file)
+    except (OSError, ValueError):
+      return {}
+
+  def estimate(self, key):
+    with self.lock:
+      if self.history is None:
+        self.history = self.load()
+      return self.history.get(key, {}).get("mean")
+
+  def save(self):
+    with self.lock:
+      pending, self.pending = self.pending, {}
+    if not pending:
+      return
+
+    path = self.get_path()
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok = True)
+      with open(path + ".lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        history = self.load()
+        for key, durations in pending.items():
+          entry = history.setdefault(key, {"mean" : durations[0], "count" : 0})
+          for duration in durations:
+            entry["count"] += 1
+            # Moving average: follows configuration and hardware changes after a few runs.
+            entry["mean"] += (duration - entry["mean"]) * max(1.0 / entry["count"], 0.3)
+        with tempfile.NamedTemporaryFile('w', dir = os.path.dirname(path), delete = False) as history_file:
+          json.dump(history, history_file, indent = 2, sort_keys = True)
+        os.replace(history_file.name, path)
+    except OSError as e:
+      print("Could not record step timings in {}: {}".format(path, e))
+
+timing_history = TimingHistory()
+atexit.register(timing_history.save)
+
+class StateStore(object):
+  """Last known power state of each appliance, shared between invocations."""
+  def __init__(self, path):
+    self.path = path
+
+  def load(self):
+    try:
+      with open(self.path) as state_file:
+        return json.load(state_file)
+    except (OSError, ValueError):
+      return {}
+
+  def get(self, appliance):
+    return self.load().get(appliance, {}).get("state")
+
+  def set(self, appliance, state):
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok = True)
+      with open(self.path + ".lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        states = self.load()
+        states[appliance] = {"state" : state, "time" : time.time()}
+        with tempfile.NamedTemporaryFile('w', dir = os.path.dirname(self.path), delete = False) as state_file:
+          json.dump(states, state_file, indent = 2, sort_keys = True)
+        os.replace(state_file.name, self.path)
+    except OSError as e:
+      print("Could not record the state of {} in {}: {}".format(appliance, self.path, e))
+
+class PowerClaims(object):
+  """Makes sure an appliance reached through several groups is powered once."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.claims = {}
+
+  def claim(self, appliance, action):
+    """Returns an Event to set when done if the caller must power the appliance, otherwise
+    waits for whoever claimed it first and returns None."""
+    with self.lock:
+      claim = self.claims.get((appliance, action))
+      if claim is None:
+        claim = {"done" : threading.Event(), "error" : None}
+        self.claims[(appliance, action)] = claim
+        return claim
+    claim["done"].wait()
+    if claim["error"] is not None:
+      raise RuntimeError("{} failed to power {} through another group: {}".format(appliance, action,
+        claim["error"]))
+    return None
+
+class PowerRun(object):
+  """State shared by all the steps of a single power sequence."""
+  def __init__(self, jobs = 1, max_per_resource = 1, rollback = False, force = False, trust_state = False,
+      state_store = None, claims = None, forwarded = False):
+    self.jobs = max(1, jobs)
+    self.max_per_resource = max(1, max_per_resource)
+    self.rollback = rollback
+    self.force = force
+    self.trust_state = trust_state
+    self.state_store = state_store
+    self.claims = claims if claims is not None else PowerClaims()
+    # Forwarded by a coordinator: every appliance is local, whatever its "host".
+    self.forwarded = forwarded
+    self.changed = []
+    self.unchanged = []
+    self.retries = {}
+    self.cancelled = threading.Event()
+    self.lock = threading.Lock()
+    self.children = set()
+
+  def fork(self, claims = None):
+    """A run with the same settings and its own cancellation, e.g. for an unrelated batch target."""
+    return PowerRun(self.jobs, self.max_per_resource, self.rollback, self.force, self.trust_state,
+      self.state_store, claims, self.forwarded)
+
+  def register(self, conn):
+    with self.lock:
+      self.children.add(conn)
+    self.check_cancelled()
+
+  def record_retry(self, step):
+    with self.lock:
+      self.retries[step] = self.retries.get(step, 0) + 1
+
+  def unregister(self, conn):
+    with self.lock:
+      self.children.discard(conn)
+
+  def cancel(self):
+    self.cancelled.set()
+    with self.lock:
+      children = list(self.children)
+    for conn in children:
+      if conn.isalive():
+        conn.terminate(True)
+
+  def check_cancelled(self):
+    if self.cancelled.is_set():
+      raise RuntimeError("Power sequence cancelled because a sibling operation failed")
+
+resource_semaphores = {}
+resource_semaphores_lock = threading.Lock()
+
+def get_resource_semaphore(resource, limit):
+  with resource_semaphores_lock:
+    if resource not in resource_semaphores:
+      resource_semaphores[resource] = threading.BoundedSemaphore(limit)
+    return resource_semaphores[resource]
+
+def get_power_resource(json_communication_method):
+  if json_communication_method['type'] == 'serial':
+    if 'device' not in json_communication_method.keys():
+      return "serial:{}".format(format_device_match(json_communication_method['match']))
+    return "serial:{}".format(json_communication_method['device'])
+  elif json_communication_method['type'] == 'usb':
+    if 'usb-address' not in json_communication_method.keys():
+      return "usb:{}".format(format_device_match(json_communication_method['hub-match']))
+    return "usb:{}".format(json_communication_method['usb-address'])
+  return None
+
+class LeaseSettings(object):
+  def __init__(self):
+    # Shared by every user of the lab host, unlike the per user cache directory. Empty disables leases.
+    # For several users to share it, the admin creates it owned by their group, setgid, and they
+    # run with a group writable umask; lab-controller never changes its permissions.
+    self.directory = os.environ.get("LAB_CONTROLLER_LEASE_DIR", "/tmp/lab-controller-leases")
+    self.poll_interval = 0.2
+
+lease_settings = LeaseSettings()
+
+def check_lease_directory(directory):
+  os.makedirs(directory, exist_ok = True)
+  if not stat.S_ISDIR(os.lstat(directory).st_mode):
+    raise RuntimeError("Lease directory {} is not a directory".format(directory))
+
+def open_lease_file(directory, name, flags = os.O_RDWR):
+  """Opens a file of the lease directory, never through a symbolic link planted there."""
+  check_lease_directory(directory)
+  path = os.path.join(directory, name)
+  try:
+    return os.open(path, flags | os.O_CREAT | os.O_NOFOLLOW, 0o666)
+  except PermissionError:
+    if flags != os.O_RDWR:
+      raise
+    # A lock file of another user: flock works as well on a read only descriptor.
+    return os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+
+class ResourceFileLock(object):
+  """Exclusive access to a physical resource across lab-controller processes.
+
+  Threads of one process share the flock, their concurrency is bounded by the resource
+  semaphore; other processes wait for the last of them to finish.
+  """
+  def __init__(self, resource):
+    self.name = re.sub(r'[^A-Za-z0-9_.-]', '_', resource) + ".lock"
+    self.mutex = threading.Lock()
+    self.fd = None
+    self.count = 0
+
+  def acquire(self):
+    with self.mutex:
+      if self.count == 0:
+        self.fd = open_lease_file(lease_settings.directory, self.name)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+      self.count += 1
+
+  def release(self):
+    with self.mutex:
+      self.count -= 1
+      if self.count == 0:
+        os.close(self.fd)
+        self.fd = None
+
+resource_file_locks = {}
+
+@contextlib.contextmanager
+def hold_resource_lock(resource):
+  if not lease_settings.directory or resource is None:
+    yield
+    return
+
+  with resource_semaphores_lock:
+    lock = resource_file_locks.setdefault(resource, ResourceFileLock(resource))
+  with tracer.span("resource-lock", resource = resource):
+    lock.acquire()
+  try:
+    yield
+  finally:
+    lock.release()
+
+def is_process_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+class LeaseManager(object):
+  """Time bounded ownership of appliances and of the devices they use, shared by every
+  lab-controller process of the host through a flock protected json file.
+
+  Waiters are served in arrival order, except that a waiter is never held back by an
+  earlier one asking for unrelated keys. A lease either expires or, when taken for a
+  single command, dies with its process.
+  """
+  def __init__(self, directory):
+    self.directory = directory
+    self.path = os.path.join(directory, "leases.json")
+
+  @contextlib.contextmanager
+  def locked(self):
+    fd = open_lease_file(self.directory, "leases.lock")
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      try:
+        with os.fdopen(os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW)) as state_file:
+          state = json.load(state_file)
+      except (OSError, ValueError):
+        state = {}
+      state.setdefault("leases", {})
+      state.setdefault("queue", [])
+      state.setdefault("next-ticket", 0)
+      self.clean(state)
+      yield state
+      state_name = "leases.json.{}".format(binascii.hexlify(os.urandom(6)).decode())
+      with os.fdopen(open_lease_file(self.directory, state_name, os.O_WRONLY | os.O_EXCL), 'w') as state_file:
+        json.dump(state, state_file, indent = 2, sort_keys = True)
+      os.replace(os.path.join(self.directory, state_name), self.path)
+    finally:
+      os.close(fd)
+
+  def is_valid(self, record):
+    if record.get("expires") is not None and record["expires"] <= time.time():
+      return False
+    return record.get("pid") is None or is_process_alive(record["pid"])
+
+  def clean(self, state):
+    state["leases"] = {key : lease for key, lease in state["leases"].items() if self.is_valid(lease)}
+    state["queue"] = [entry for entry in state["queue"] if self.is_valid(entry)]
+
+  def get_blockers(self, state, ticket, keys, owner):
+    blockers = set(state["leases"][key]["owner"] for key in keys
+      if key in state["leases"] and state["leases"][key]["owner"] != owner)
+    # Waiters queued for any key owner holds wait for owner, not the other way around.
+    held = set(key for key, lease in state["leases"].items() if lease["owner"] == owner)
+    for entry in state["queue"]:
+      entry_keys = set(entry["keys"])
+      if entry["ticket"] < ticket and entry["owner"] != owner and entry_keys & set(keys) and \
+          not entry_keys & held:
+        blockers.add(entry["owner"])
+    return blockers
+
+  def acquire(self, keys, owner, duration = None, timeout = None):
+    """Waits for keys and returns (the keys newly granted to owner, the wait in seconds).
+    Without duration the lease lasts as long as this process."""
+    start = time.time()
+    pid = os.getpid() if duration is None else None
+    with self.locked() as state:
+      ticket = state["next-ticket"]
+      state["next-ticket"] += 1
+      state["queue"].append({"ticket" : ticket, "owner" : owner, "keys" : keys, "pid" : os.getpid(),
+        "enqueued" : start})
+
+    announced = False
+    try:
+      while True:
+        with self.locked() as state:
+          blockers = self.get_blockers(state, ticket, keys, owner)
+          if not blockers:
+            now = time.time()
+            granted = [key for key in keys if key not in state["leases"]]
+            for key in keys:
+              if key in state["leases"] and duration is None:
+                continue
+              state["leases"][key] = {"owner" : owner, "pid" : pid, "acquired" : now,
+                "expires" : now + duration if duration is not None else None}
+            state["queue"] = [entry for entry in state["queue"] if entry["ticket"] != ticket]
+            return granted, now - start
+
+        if timeout is not None and time.time() - start >= timeout:
+          raise RuntimeError("Timed out after {:.1f} s waiting for {} held or queued by {}".format(
+            time.time() - start, ', '.join(keys), ', '.join(sorted(blockers))))
+        if not announced:
+          print("Waiting for {} held or queued by {}".format(', '.join(keys), ', '.join(sorted(blockers))))
+          announced = True
+        time.sleep(lease_settings.poll_interval)
+    except BaseException:
+      with self.locked() as state:
+        state["queue"] = [entry for entry in state["queue"] if entry["ticket"] != ticket]
+      raise
+
+  def release(self, owner, keys = None):
+    with self.locked() as state:
+      released = [key for key, lease in state["leases"].items()
+        if lease["owner"] == owner and (keys is None or key in keys)]
+      for key in released:
+        del state["leases"][key]
+    return released
+
+  def list(self):
+    with self.locked() as state:
+      return {"leases" : state["leases"], "queue" : state["queue"]}
+
+def get_lease_keys(appliance, config):
+  """The appliances of the group closure of appliance and the consoles and usb ports they use."""
+  keys = set()
+  for name in config.appliances[appliance].closure:
+    compiled_appliance = config.appliances[name]
+    keys.add("appliance:{}".format(name))
+    for json_communication in compiled_appliance.json.get('communications', []):
+      if json_communication.get('type') == 'serial':
+        keys.add(get_power_resource(json_communication))
+    for power_method in compiled_appliance.power:
+      if power_method.type == 'usb':
+        for usb_port in get_usb_ports(power_method.json):
+          keys.add("{}:{}".format(power_method.resource, usb_port))
+  return keys
+
+def new_lease_owner():
+  return "{}-{}".format(socket.gethostname(), binascii.hexlify(os.urandom(6)).decode())
 
 def intersect(l1, l2):
   expected_len = min(len(l1), len(l2))
   intersection_len = len(set(l1) & set(l2))
   return intersection_len == expected_len
 
+DEVICE_MATCH_KEYS = ["vendor", "product", "serial", "kernels"]
+
+def check_device_match(json_match):
+  if not isinstance(json_match, dict) or len(json_match) == 0:
+    raise RuntimeError("A device match needs at least one of {}".format(', '.join(DEVICE_MATCH_KEYS)))
+  for key in json_match.keys():
+    if key not in DEVICE_MATCH_KEYS:
+      raise RuntimeError("Unknown device match key {}, use {}".format(key, ', '.join(DEVICE_MATCH_KEYS)))
+
+def format_device_match(json_match):
+  return ','.join("{}={}".format(key, json_match[key]) for key in sorted(json_match.keys()))
+
 def check_serial_settings(json_appliance_section):
-  if not intersect(['device', 'baud'], json_appliance_section.keys()):
-    raise RuntimeError("Make sure that 'device' and 'baud' settings are"
+  if 'baud' not in json_appliance_section.keys() or \
+      ('device' not in json_appliance_section.keys() and 'match' not in json_appliance_section.keys()):
+    raise RuntimeError("Make sure that 'device' (or a udev 'match') and 'baud' settings are"
       " available in appliance section")
+  if 'match' in json_appliance_section.keys():
+    check_device_match(json_appliance_section['match'])
 
-def check_applicance(appliance, json_conf):
-  if appliance not in json_conf.keys():
-    print(' '.join(json_conf.keys()))
+def check_applicance(appliance, config):
+  if appliance not in config.appliances:
+    print(' '.join(config.appliances.keys()))
     raise RuntimeError("appliance {} not found in configuration.".format(appliance))
 
 def check_appliance_section(appliance_section, json_appliance):
@@ -51,11 +631,69 @@ def get_power_group(group_json):
 
   return group_json["devices"]
 
+def get_device_dependencies(json_appliance):
+  dependencies = []
+  for key in ["after", "depends-on"]:
+    if key not in json_appliance.keys():
+      continue
+    if isinstance(json_appliance[key], str):
+      dependencies.append(json_appliance[key])
+    else:
+      dependencies.extend(json_appliance[key])
+  return dependencies
+
+def get_group_stages(devices, config):
+  dependencies = {}
+  for device in devices:
+    check_applicance(device, config)
+    dependencies[device] = [d for d in config.appliances[device].dependencies if d in devices]
+
+  stages = []
+  done = set()
+  remaining = list(devices)
+  while remaining:
+    stage = [d for d in remaining if all(dep in done for dep in dependencies[d])]
+    if not stage:
+      raise RuntimeError("Dependency cycle between group devices: {}".format(' '.join(remaining)))
+    stages.append(stage)
+    done.update(stage)
+    remaining = [d for d in remaining if d not in done]
+
+  return stages
+
 def check_expect_instance(json_expect_instance):
   if not intersect(["text", "timeout"], json_expect_instance.keys()):
     raise RuntimeError("'text' and 'timeout' data is mandatory for each expect call")
-  if not json_expect_instance["timeout"].isdigit():
+  if not str(json_expect_instance["timeout"]).isdigit():
     raise RuntimeError("'timeout' is not a number")
+  if not isinstance(json_expect_instance["text"], (str, list)) or len(json_expect_instance["text"]) == 0:
+    raise RuntimeError("'text' must be a string or a non empty list of alternatives")
+  if "window" in json_expect_instance.keys() and \
+      (not str(json_expect_instance["window"]).isdigit() or int(json_expect_instance["window"]) == 0):
+    raise RuntimeError("'window' must be a positive number of characters")
+  check_fail_patterns(json_expect_instance)
+  check_retry(json_expect_instance)
+
+def check_retry(json_instance):
+  if "retry" not in json_instance.keys():
+    return
+
+  json_retry = json_instance["retry"]
+  if not isinstance(json_retry, dict):
+    raise RuntimeError("'retry' must be a dictionary")
+  if not str(json_retry.get("attempts", 1)).isdigit() or int(json_retry.get("attempts", 1)) < 1:
+    raise RuntimeError("retry 'attempts' must be a positive number")
+  for key in ["backoff", "factor", "max-backoff", "jitter", "deadline"]:
+    if key in json_retry.keys():
+      try:
+        if float(json_retry[key]) < 0:
+          raise ValueError()
+      except (TypeError, ValueError):
+        raise RuntimeError("retry '{}' must be a non negative number".format(key))
+
+def check_fail_patterns(json_expect_instance):
+  if "fail" in json_expect_instance.keys() and not isinstance(json_expect_instance["fail"], (str, list)):
+    raise RuntimeError("'fail' must be a string or a list of patterns that abort the expect")
 
 def check_json_expect(json_expect):
   if not "expect" in json_expect.keys():
@@ -66,8 +704,17 @@ def check_json_expect(json_expect):
     check_expect_instance(json_expect_instance)
 
 def check_usb_json(json_usb):
-  if not intersect(['usb-address', 'usb-port'], json_usb):
-    raise RuntimeError("'usb-address' and 'usb-port' are required for usb power control")
+  if 'usb-port' not in json_usb or ('usb-address' not in json_usb and 'hub-match' not in json_usb):
+    raise RuntimeError("'usb-address' (or a udev 'hub-match') and 'usb-port' are required for usb power control")
+  if 'hub-match' in json_usb:
+    check_device_match(json_usb['hub-match'])
+  if len(get_usb_ports(json_usb)) == 0:
+    raise RuntimeError("'usb-port' needs at least one port")
+
+def get_usb_ports(json_usb):
+  if isinstance(json_usb['usb-port'], list):
+    return [str(port) for port in json_usb['usb-port']]
+  return [port.strip() for port in str(json_usb['usb-port']).split(',') if port.strip()]
 
 def check_io(json_command):
   if "io" not in json_command.keys():
@@ -76,6 +723,13 @@ def check_io(json_command):
   if len(json_command["io"]) == 0:
     raise RuntimeError("io list needs to have at least one element")
 
+  for io in json_command["io"]:
+    if "expect" in io.keys():
+      if "text" not in io["expect"].keys():
+        raise RuntimeError("'text' is mandatory for each io expect")
+      check_fail_patterns(io["expect"])
+      check_retry(io["expect"])
+
 def is_io_command(json_action_command):
   return "io" in json_action_command.keys()
 
@@ -93,175 +747,1170 @@ def check_command(json_communication):
     for json_action_command in json_communication['command'][action]:
       if is_invalid_command(json_action_command):
         raise RuntimeError("execute or io keys are mandatory for all actions")
+      if not isinstance(json_action_command.get("parallel", False), bool):
+        raise RuntimeError("'parallel' must be true or false")
+      if "timeout" in json_action_command.keys() and not str(json_action_command["timeout"]).isdigit():
+        raise RuntimeError("'timeout' is not a number")
+      check_retry(json_action_command)
 
       check_io(json_action_command)
 
-def get_serial_cmd(device, baud):
-  return "socat -t0 STDIO,raw,echo=0,escape=0x03,nonblock=1 " \
-      "file:{},b{},cs8,parenb=0,cstopb=0,clocal=0,raw,echo=0".format(device, baud)
+def open_serial_fd(device, baud, flags = os.O_RDWR):
+  baud_attribute = "B{}".format(baud)
+  if not hasattr(termios, baud_attribute):
+    raise RuntimeError("Unsupported baud rate {} for {}".format(baud, device))
+
+  try:
+    fd = os.open(device, flags | os.O_NOCTTY | os.O_NONBLOCK)
+  except OSError as e:
+    raise RuntimeError("Cannot open serial device {}: {}".format(device, e))
+
+  # Same line settings socat used: cs8, parenb=0, cstopb=0, clocal=0, raw, echo=0
+  iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+  iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP |
+    termios.INLCR | termios.IGNCR | termios.ICRNL | termios.IXON)
+  oflag &= ~termios.OPOST
+  lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+  cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | termios.CLOCAL)
+  cflag |= termios.CS8 | termios.CREAD
+  cc[termios.VMIN] = 1
+  cc[termios.VTIME] = 0
+  speed = getattr(termios, baud_attribute)
+  termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+  return fd
+
+class SerialSession(object):
+  """A serial port opened once and shared by sequential actions."""
+  def __init__(self, device, baud):
+    self.device = device
+    self.baud = baud
+    self.lock = threading.RLock()
+    self.conn = None
+
+  def open(self):
+    fd = open_serial_fd(self.device, self.baud)
+    self.conn = pexpect.fdpexpect.fdspawn(fd, timeout = 2, encoding = 'utf-8', codec_errors = 'ignore')
+
+  def close(self):
+    with self.lock:
+      if self.conn is not None and self.conn.isalive():
+        self.conn.close()
+      self.conn = None
+
+  @contextlib.contextmanager
+  def acquire(self, logfile = None, flush = True):
+    """Yields the open port. flush is for the start of an action; the later steps of the
+    action keep what the previous ones left unread."""
+    with self.lock:
+      if self.conn is not None and self.conn.flag_eof:
+        self.close()
+      if self.conn is None or not self.conn.isalive():
+        self.open()
+
+      if flush:
+        # Drop whatever arrived since the previous action, as a fresh open would.
+        termios.tcflush(self.conn.child_fd, termios.TCIFLUSH)
+        self.conn.buffer = ''
+      self.conn.logfile_read = logfile
+      try:
+        yield self.conn
+      except (OSError, pexpect.EOF):
+        # The port went away under us. Reopen it on the next action.
+        self.close()
+        raise
+      finally:
+        if self.conn is not None:
+          self.conn.logfile_read = None
+
+serial_sessions = {}
+serial_sessions_lock = threading.Lock()
+
+def do_on_serial(json_serial, logfile, operation, flush = False):
+  """Calls operation with the port of json_serial. The device is looked up and, if an error
+  closed it, opened again on every call, so a retry survives an adapter reset or re-enumeration."""
+  json_serial = resolve_serial_device(json_serial)
+  with get_serial_session(json_serial['device'], json_serial['baud']).acquire(logfile, flush) as conn:
+    return operation(conn)
+
+def get_serial_session(device, baud):
+  key = (device, str(baud))
+  with serial_sessions_lock:
+    if key not in serial_sessions:
+      serial_sessions[key] = SerialSession(device, baud)
+    return serial_sessions[key]
+
+@atexit.register
+def close_serial_sessions():
+  with serial_sessions_lock:
+    for session in serial_sessions.values():
+      session.close()
 
 def do_execute(execute, logger, shell = False):
   if shell:
     execute = "bash -c '{}'".format(execute)
 
-  return pexpect.spawnu(execute, env = os.environ, codec_errors = 'ignore', logfile = logger)
-
-def do_expect(conn, expect = None, match_type = None, timeout = 2):
-  if expect:
+  with tracer.span("execute", command = execute):
+    return pexpect.spawnu(execute, env = os.environ, codec_errors = 'ignore', logfile = logger)
+
+def get_retry_delay(json_retry, attempt):
+  delay = float(json_retry.get("backoff", 1)) * float(json_retry.get("factor", 2)) ** (attempt - 1)
+  if "max-backoff" in json_retry.keys():
+    delay = min(delay, float(json_retry["max-backoff"]))
+  jitter = float(json_retry.get("jitter", 0))
+  return max(0, delay * (1 + random.uniform(-jitter, jitter)))
+
+def run_with_retry(json_retry, step, operation, run = None):
+  """Calls operation until it succeeds, following a "retry" policy: attempts, exponential
+  backoff (seconds) multiplied by factor at each attempt up to max-backoff, a relative
+  jitter and an overall deadline (seconds). Without a policy operation runs once."""
+  if not json_retry:
+    return operation()
+
+  attempts = int(json_retry.get("attempts", 1))
+  deadline = time.time() + float(json_retry["deadline"]) if "deadline" in json_retry.keys() else None
+  for attempt in range(1, attempts + 1):
     try:
-      if match_type == "re":
-        conn.expect(expect, timeout = int(timeout))
+      return operation()
+    except Exception as e:
+      if run is not None and run.cancelled.is_set():
+        raise
+      delay = get_retry_delay(json_retry, attempt)
+      if attempt == attempts or (deadline is not None and time.time() + delay >= deadline):
+        raise RuntimeError("{} failed after {} attempt(s): {}".format(step, attempt, e))
+      print("{} failed (attempt {}/{}), retrying in {:.1f}s: {}".format(step, attempt, attempts, delay,
+        str(e).split("\n")[0]))
+
+    if run is not None:
+      run.record_retry(step)
+    with tracer.span("retry-wait", step = step, attempt = attempt, delay = round(delay, 3)):
+      if run is not None:
+        run.cancelled.wait(delay)
+        run.check_cancelled()
       else:
-        conn.expect_exact(expect, float(timeout))
+        time.sleep(delay)
+
+EXPECT_SEARCH_WINDOW = 4096
+
+class ExpectMatcher(object):
+  """Incremental matcher of exact strings and regular expressions over a stream.
+
+  Only a bounded window is searched: the new chunk plus enough of the previous
+  data for a match to straddle chunks. A regular expression match therefore spans
+  at most search_window characters of earlier chunks; expect entries raise it with
+  "window". Regular expressions match across lines (re.DOTALL) as with pexpect.
+  The latest output is kept in a bounded ring buffer for diagnostics.
+  """
+  def __init__(self, patterns, search_window = None, diagnostics_size = 4096):
+    search_window = EXPECT_SEARCH_WINDOW if search_window is None else int(search_window)
+    self.patterns = []
+    self.carry = 0
+    for text, match_type in patterns:
+      if text is pexpect.EOF:
+        self.patterns.append(None)
+      elif match_type == "re":
+        self.patterns.append(re.compile(text, re.DOTALL))
+        self.carry = max(self.carry, search_window)
+      else:
+        self.patterns.append(text)
+        self.carry = max(self.carry, len(text) - 1)
+    self.window = ''
+    self.bytes_read = 0
+    self.diagnostics = collections.deque()
+    self.diagnostics_length = 0
+    self.diagnostics_size = diagnostics_size
+
+  def remember(self, data):
+    self.diagnostics.append(data)
+    self.diagnostics_length += len(data)
+    while self.diagnostics_length - len(self.diagnostics[0]) >= self.diagnostics_size:
+      self.diagnostics_length -= len(self.diagnostics.popleft())
+
+  def get_diagnostics(self):
+    return ''.join(self.diagnostics)[-self.diagnostics_size:]
+
+  def feed(self, data):
+    """Returns (pattern index, data after the match) on a match, otherwise None."""
+    self.bytes_read += len(data)
+    self.remember(data)
+    window = self.window + data
+    best = None
+    for index, pattern in enumerate(self.patterns):
+      if pattern is None:
+        continue
+      if isinstance(pattern, str):
+        start = window.find(pattern)
+        end = start + len(pattern)
+      else:
+        match = pattern.search(window)
+        start, end = (match.start(), match.end()) if match else (-1, -1)
+      if start >= 0 and (best is None or start < best[1]):
+        best = (index, start, end)
 
-      print("Expect success: {}".format(expect))
-    except pexpect.TIMEOUT:
-      raise RuntimeError("""Expect fail: {}
+    if best is None:
+      self.window = window[max(0, len(window) - self.carry):] if self.carry else ''
+      return None
+
+    self.window = ''
+    return best[0], window[best[2]:]
+
+def format_expect_failure(reason, matcher):
+  return """Expect fail: {}
 *************BUFFER DUMP START************
 {}
 *************BUFFER DUMP END**************
-""".format(expect, conn.buffer))
+""".format(reason, matcher.get_diagnostics())
+
+EXPECT_CANCEL_POLL_INTERVAL = 0.5
+
+def stream_expect(conn, patterns, timeout, failures = [], chunk_size = 4096, stats = None, cancelled = None,
+    search_window = None):
+  """Reads conn in chunks until one of patterns matches and returns its index.
+
+  patterns and failures are lists of (text, match_type); text may be pexpect.EOF.
+  A failure pattern raises as soon as it is seen instead of waiting for timeout.
+  The number of characters read is stored in stats["bytes-read"] when given.
+  When the cancelled Event is set the wait is abandoned.
+  """
+  matcher = ExpectMatcher(patterns + failures, search_window)
+  if stats is not None:
+    stats["bytes-read"] = 0
+  try:
+    return stream_match(conn, matcher, patterns, failures, timeout, chunk_size, cancelled)
+  finally:
+    if stats is not None:
+      stats["bytes-read"] = matcher.bytes_read
+
+def stream_match(conn, matcher, patterns, failures, timeout, chunk_size, cancelled = None):
+  deadline = time.time() + float(timeout) if timeout is not None else None
+  data = conn.buffer
+  conn.buffer = ''
+  while True:
+    if data:
+      result = matcher.feed(data)
+      if result is not None:
+        index, conn.buffer = result
+        if index >= len(patterns):
+          raise RuntimeError(format_expect_failure("found failure pattern {}".format(
+            failures[index - len(patterns)][0]), matcher))
+        return index
+
+    remaining = deadline - time.time() if deadline is not None else None
+    if remaining is not None and remaining <= 0:
+      raise RuntimeError(format_expect_failure(' | '.join(str(text) for text, _ in patterns), matcher))
+    if cancelled is not None:
+      if cancelled.is_set():
+        raise RuntimeError("Expect cancelled: {}".format(' | '.join(str(text) for text, _ in patterns)))
+      remaining = min(remaining, EXPECT_CANCEL_POLL_INTERVAL) if remaining is not None \
+        else EXPECT_CANCEL_POLL_INTERVAL
+
+    try:
+      data = conn.read_nonblocking(chunk_size, remaining)
+    except pexpect.TIMEOUT:
+      data = ''
+    except pexpect.EOF:
+      data = read_after_exit(conn, chunk_size)
+      if data:
+        continue
+      for index, (text, _) in enumerate(patterns + failures):
+        if text is pexpect.EOF:
+          if index >= len(patterns):
+            raise RuntimeError(format_expect_failure("process exited", matcher))
+          return index
+      raise RuntimeError(format_expect_failure("{} (reached end of file)".format(
+        ' | '.join(str(text) for text, _ in patterns)), matcher))
+
+EXIT_OUTPUT_GRACE = 0.2
+
+def read_after_exit(conn, chunk_size):
+  """pexpect reports EOF as soon as the child is reaped and nothing is readable, but what the child
+  wrote just before exiting can still be on its way to the pty master. Returns that output, if any."""
+  if not isinstance(conn, pexpect.spawn) or conn.closed:
+    return ''
+  if not select.select([conn.child_fd], [], [], EXIT_OUTPUT_GRACE)[0]:
+    return ''
+  try:
+    return pexpect.spawnbase.SpawnBase.read_nonblocking(conn, chunk_size)
+  except pexpect.EOF:
+    return ''
+
+def get_expect_patterns(json_expect_instance, default_match_type = None):
+  match_type = json_expect_instance.get("match-type", default_match_type)
+  texts = json_expect_instance["text"]
+  if isinstance(texts, str):
+    texts = [texts]
+  return [(text, match_type) for text in texts]
+
+def get_fail_patterns(json_expect_instance, default_match_type = None):
+  match_type = json_expect_instance.get("match-type", default_match_type)
+  texts = json_expect_instance.get("fail", [])
+  if isinstance(texts, str):
+    texts = [texts]
+  return [(text, match_type) for text in texts]
+
+def do_expect(conn, expect = None, match_type = None, timeout = 2, run = None, failures = [], search_window = None):
+  if expect:
+    patterns = expect if isinstance(expect, list) else [(expect, match_type)]
+    with tracer.span("expect", pattern = ' | '.join(str(text) for text, _ in patterns), timeout = timeout) as span:
+      index = stream_expect(conn, patterns, timeout, failures, stats = span,
+        cancelled = run.cancelled if run is not None else None, search_window = search_window)
+      span["matched"] = str(patterns[index][0])
+    print("Expect success: {}".format(patterns[index][0]))
 
 def do_send(conn, text = None):
   if text:
-    conn.send(text)
+    with tracer.span("send", bytes = len(text)):
+      conn.send(text)
+
+def open_command_log(log_directory, name, echo = None, listener = None):
+  timestr = time.strftime("%Y%m%d-%H%M%S")
+  log_file_basename = "lab-controller-{}-{}".format(name, timestr)
+  suffix = ""
+  # Concurrent commands can start in the same second: never reuse a log file.
+  for attempt in range(1000):
+    log_file_name = os.path.join(log_directory, "{}{}.log".format(log_file_basename, suffix))
+    try:
+      return Tee(log_file_name, "x", echo, listener)
+    except FileExistsError:
+      suffix = "-{}".format(attempt + 1)
+  raise RuntimeError("Could not create a log file for {} in {}".format(name, log_directory))
+
+def do_expect_attempt(conn, expect_entry, default_match_type = None, run = None, send = None):
+  do_send(conn, send)
+  do_expect(conn, get_expect_patterns(expect_entry, default_match_type), None, expect_entry.get("timeout", 2),
+    run, get_fail_patterns(expect_entry, default_match_type), expect_entry.get("window"))
+
+def do_expect_step(conn, expect_entry, default_match_type = None, run = None, send = None):
+  """Sends send, if any, and expects expect_entry, retrying both following its retry policy."""
+  run_with_retry(expect_entry.get("retry"), "expect {}".format(expect_entry["text"]),
+    lambda: do_expect_attempt(conn, expect_entry, default_match_type, run, send), run)
+
+def do_io(conn, io_list, run = None):
+  for io in io_list:
+    if run is not None:
+      run.check_cancelled()
+
+    if "expect" in io.keys():
+      do_expect_step(conn, io["expect"], None, run, io.get("send"))
+    elif "send" in io.keys():
+      do_send(conn, io["send"])
+
+def do_host_command(action_json, log_directory, run = None):
+  if run is None:
+    run = PowerRun()
 
-def do_host_command(action_json, log_directory, kill_after_expect = False):
   if "execute" not in action_json.keys():
     raise RuntimeError("'execute' directive required for command")
 
   execute = action_json["execute"]
 
-  timestr = time.strftime("%Y%m%d-%H%M%S")
   file_suffix = os.path.basename(execute.split()[0]).replace(" ", "_")
-  log_file_basename = "lab-controller-{}-{}.log".format(file_suffix, timestr)
-  log_file_name = os.path.join(log_directory, log_file_basename)
-  logfile = Tee(log_file_name, "w")
-
-  exec_conn = do_execute(execute, logfile, True)
+  run.check_cancelled()
+  with tracer.span("host-command", command = execute) as span, \
+      open_command_log(log_directory, file_suffix) as logfile:
+    exec_conn = do_execute(execute, logfile, True)
+    timer = None
+    if "timeout" in action_json.keys():
+      timer = threading.Timer(float(action_json["timeout"]), exec_conn.terminate, [True])
+      timer.start()
+    try:
+      run.register(exec_conn)
+      run_host_command_io(exec_conn, action_json, execute, run)
+    except Exception:
+      if timer is not None and not timer.is_alive():
+        raise RuntimeError("Host Command timed out after {}s: {}".format(action_json["timeout"], execute))
+      raise
+    finally:
+      if timer is not None:
+        timer.cancel()
+      run.unregister(exec_conn)
+      if exec_conn.isalive():
+        exec_conn.terminate(True)
+      span["exit-status"] = exec_conn.exitstatus
+      span["signal-status"] = exec_conn.signalstatus
+
+def run_host_command_io(exec_conn, action_json, execute, run = None):
   if "io" in action_json.keys():
-    for io in action_json["io"]:
-      if "send" in io.keys():
-        do_send(exec_conn, io["send"])
-
-      if "expect" in io.keys():
-        expect = io["expect"]
-        text = expect["text"]
-
-        match_type = None
-        if "match-type" in expect:
-          match_type = expect["match-type"]
-
-        timeout = 2
-        if "timeout" in expect:
-          timeout = expect["timeout"]
+    do_io(exec_conn, action_json["io"], run)
 
-        do_expect(exec_conn, text, match_type, timeout)
-
-
-  if kill_after_expect and exec_conn.isalive():
-    #we are done here and we want to leave.
-    if not exec_conn.terminate(True):
-      raise RuntimeError("Application blocked and could not be terminated. Error")
-
-  if not kill_after_expect and exec_conn.wait() != 0:
-    do_expect(exec_conn, pexpect.EOF)
-    exec_conn.close()
+  # Drain the output up to EOF before reaping, so the child never blocks on a full pty
+  # and the tail of its output reaches the log.
+  do_expect(exec_conn, pexpect.EOF, timeout = None)
+  # The child closes the pty while it exits: closing our side before it is gone hangs it up.
+  exec_conn.wait()
+  exec_conn.close()
+  if exec_conn.exitstatus != 0:
     raise RuntimeError("Host Command did not execute successfully: {}. Exit status {}; Signal status: {}".format(
       execute, exec_conn.exitstatus, exec_conn.signalstatus))
 
-  do_expect(exec_conn, pexpect.EOF)
-  exec_conn.close()
-
-def do_power_serial(action, json_power, log_directory):
-  check_serial_settings(json_power)
-  check_command(json_power)
-
-  power_cmd = get_serial_cmd(json_power['device'], json_power['baud'])
-
-  if action in json_power["command"]:
-    for json_action_command in json_power['command'][action]:
-      if "io" not in json_action_command.keys():
-        raise RuntimeError("io section required for serial devices")
-
-      check_io(json_action_command)
-
-    json_action_command["execute"] = power_cmd
-    do_host_command(json_action_command, log_directory, True)
-
-def do_power_usb(action, json_power, log_directory):
-  check_usb_json(json_power)
+def do_power_serial(action, json_power, log_directory, run = None):
+  if action not in json_power["command"]:
+    return
 
-  execute = 'uhubctl -a {} -l {} -p {}'.format(action, json_power['usb-address'], json_power['usb-port'])
+  device = resolve_serial_device(json_power)['device']
+  with open_command_log(log_directory, "serial-{}".format(os.path.basename(device))) as logfile:
+    for index, json_action_command in enumerate(json_power['command'][action]):
+      run_with_retry(json_action_command.get("retry", json_power.get("retry")),
+        "serial {} {}".format(device, action),
+        lambda: do_on_serial(json_power, logfile, lambda conn: do_io(conn, json_action_command["io"], run),
+          flush = index == 0), run)
+
+class UsbSettings(object):
+  def __init__(self):
+    self.backend = "auto"
+    self.sysfs_root = os.environ.get("LAB_CONTROLLER_SYSFS", "/sys")
+
+usb_settings = UsbSettings()
+
+usb_port_paths = {}
+usb_port_paths_lock = threading.Lock()
+
+def get_usb_port_path(usb_address, usb_port):
+  """Returns the sysfs directory of a hub port, or None when the kernel does not expose it.
+
+  A hub at 1-2.3 exposes its ports as 1-2.3:1.0/1-2.3-port<N>; a root hub (address 1) as
+  1-0:1.0/usb1-port<N>. Found ports are cached so the bus is looked at once per port; a miss
+  is not, since the port directories only appear once the hub driver is bound.
+  """
+  key = (usb_settings.sysfs_root, usb_address, usb_port)
+  with usb_port_paths_lock:
+    if key in usb_port_paths:
+      return usb_port_paths[key]
+
+  if '-' in usb_address:
+    interface, port_prefix = "{}:1.0".format(usb_address), usb_address
+  else:
+    interface, port_prefix = "{}-0:1.0".format(usb_address), "usb{}".format(usb_address)
+  port_path = os.path.join(usb_settings.sysfs_root, "bus", "usb", "devices", interface,
+    "{}-port{}".format(port_prefix, usb_port))
+  if not os.path.exists(os.path.join(port_path, "disable")):
+    return None
+
+  with usb_port_paths_lock:
+    usb_port_paths[key] = port_path
+  return port_path
+
+def read_usb_port_status(port_path):
+  with open(os.path.join(port_path, "disable")) as disable:
+    powered = disable.read().strip() == "0"
+  return {"power" : "on" if powered else "off", "connected" : os.path.exists(os.path.join(port_path, "device"))}
+
+def set_usb_ports_sysfs(action, usb_address, port_paths):
+  for port_path in port_paths.values():
+    with open(os.path.join(port_path, "disable"), 'w') as disable:
+      disable.write("1" if action == "off" else "0")
+
+  status = {}
+  for usb_port, port_path in port_paths.items():
+    status[usb_port] = read_usb_port_status(port_path)
+    if status[usb_port]["power"] != action:
+      raise RuntimeError("Port {} of hub {} did not power {}".format(usb_port, usb_address, action))
+  print("Hub {} ports {} powered {}".format(usb_address, ', '.join(port_paths.keys()), action))
+  return status
+
+def get_sysfs_usb_port_paths(usb_address, usb_ports):
+  port_paths = collections.OrderedDict()
+  for usb_port in usb_ports:
+    port_path = get_usb_port_path(usb_address, usb_port)
+    if port_path is None or not os.access(os.path.join(port_path, "disable"), os.W_OK):
+      return None
+    port_paths[usb_port] = port_path
+  return port_paths
+
+NETLINK_KOBJECT_UEVENT = 15
+
+class DeviceIndex(object):
+  """Current usb serial adapters and hubs, looked up by udev like attributes.
+
+  Entries are keyed by their sysfs path and indexed by vendor, product, serial and
+  every KERNELS name on their path, so a lookup is a few set intersections. The index
+  is kept on disk between invocations; a looked up entry that vanished or whose attributes
+  changed (the device was re-enumerated or replaced) triggers a rescan, and the daemon updates it from kernel uevents.
+  """
+  def __init__(self, sysfs_root, cache_path = None):
+    self.sysfs_root = sysfs_root
+    self.cache_path = cache_path
+    self.lock = threading.Lock()
+    self.entries = {}
+    self.by_attribute = {}
+
+  def read_attribute(self, path, name):
+    try:
+      with open(os.path.join(path, name)) as attribute:
+        return attribute.read().strip()
+    except OSError:
+      return None
+
+  def get_usb_device_path(self, path):
+    while path.startswith(self.sysfs_root) and path != self.sysfs_root:
+      if os.path.exists(os.path.join(path, "idVendor")):
+        return path
+      path = os.path.dirname(path)
+    return None
+
+  def make_entry(self, kind, node, path, usb_device_path):
+    return {"kind" : kind, "node" : node, "path" : path,
+      "vendor" : self.read_attribute(usb_device_path, "idVendor"),
+      "product" : self.read_attribute(usb_device_path, "idProduct"),
+      "serial" : self.read_attribute(usb_device_path, "serial"),
+      "kernels" : [name for name in os.path.relpath(path, self.sysfs_root).split("/") if name]}
+
+  def read_tty(self, name):
+    device_link = os.path.join(self.sysfs_root, "class", "tty", name, "device")
+    if not os.path.exists(device_link):
+      return None
+    path = os.path.realpath(os.path.join(self.sysfs_root, "class", "tty", name))
+    usb_device_path = self.get_usb_device_path(os.path.realpath(device_link))
+    if usb_device_path is None:
+      return None
+    return self.make_entry("tty", os.path.join("/dev", name), path, usb_device_path)
+
+  def read_usb_device(self, path):
+    if self.read_attribute(path, "bDeviceClass") != "09":
+      return None
+    return self.make_entry("hub", os.path.basename(path), path, path)
+
+  def add(self, entry):
+    self.remove(entry["path"])
+    self.entries[entry["path"]] = entry
+    for key in ["kind", "vendor", "product", "serial"]:
+      self.by_attribute.setdefault((key, entry[key]), set()).add(entry["path"])
+    for name in entry["kernels"]:
+      self.by_attribute.setdefault(("kernels", name), set()).add(entry["path"])
+
+  def is_current(self, entry):
+    """Whether the device now at the entry's path is still the indexed one: a different adapter
+    can be enumerated at the same path without the daemon seeing it."""
+    if entry["kind"] == "tty":
+      current = self.read_tty(os.path.basename(entry["node"]))
+    else:
+      current = self.read_usb_device(entry["path"])
+    return current is not None and all(current[key] == entry[key] for key in ["path", "vendor", "product", "serial"])
+
+  def remove(self, path):
+    entry = self.entries.pop(path, None)
+    if entry is None:
+      return
+    for key in ["kind", "vendor", "product", "serial"]:
+      self.by_attribute.get((key, entry[key]), set()).discard(path)
+    for name in entry["kernels"]:
+      self.by_attribute.get(("kernels", name), set()).discard(path)
+
+  def scan(self):
+    with self.lock:
+      self.entries = {}
+      self.by_attribute = {}
+      tty_directory = os.path.join(self.sysfs_root, "class", "tty")
+      for name in sorted(os.listdir(tty_directory)) if os.path.isdir(tty_directory) else []:
+        entry = self.read_tty(name)
+        if entry is not None:
+          self.add(entry)
+      usb_directory = os.path.join(self.sysfs_root, "bus", "usb", "devices")
+      for name in sorted(os.listdir(usb_directory)) if os.path.isdir(usb_directory) else []:
+        entry = self.read_usb_device(os.path.realpath(os.path.join(usb_directory, name)))
+        if entry is not None:
+          self.add(entry)
+    self.save()
+
+  def load(self):
+    try:
+      with open(self.cache_path) as cache_file:
+        cache = json.load(cache_file)
+    except (OSError, ValueError, TypeError):
+      return False
+    if cache.get("sysfs-root") != self.sysfs_root:
+      return False
+    with self.lock:
+      for entry in cache["entries"]:
+        self.add(entry)
+    return True
+
+  def save(self):
+    if self.cache_path is None:
+      return
+    with self.lock:
+      entries = list(self.entries.values())
+    try:
+      os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+      with tempfile.NamedTemporaryFile('w', dir = os.path.dirname(self.cache_path), delete = False) as cache_file:
+        json.dump({"sysfs-root" : self.sysfs_root, "entries" : entries}, cache_file)
+      os.replace(cache_file.name, self.cache_path)
+    except OSError as e:
+      print("Could not write the device index {}: {}".format(self.cache_path, e))
+
+  def find(self, kind, json_match):
+    with self.lock:
+      paths = set(self.by_attribute.get(("kind", kind), set()))
+      for key, value in json_match.items():
+        paths &= self.by_attribute.get((key, str(value)), set())
+      return [self.entries[path] for path in sorted(paths)]
+
+  def lookup(self, kind, json_match):
+    """Returns the device node (or hub address) matching json_match, rescanning once when the
+    indexed device is gone, replaced or unknown."""
+    entries = self.find(kind, json_match)
+    if len(entries) != 1 or not self.is_current(entries[0]):
+      self.scan()
+      entries = self.find(kind, json_match)
+
+    if len(entries) == 0:
+      raise RuntimeError("No {} matches {}".format(kind, format_device_match(json_match)))
+    if len(entries) > 1:
+      raise RuntimeError("{} {}s match {}: {}".format(len(entries), kind, format_device_match(json_match),
+        ', '.join(entry["node"] for entry in entries)))
+    return entries[0]["node"]
+
+  def handle_uevent(self, message):
+    """Updates the index from a kernel uevent: ACTION@DEVPATH followed by KEY=VALUE fields."""
+    fields = message.decode('utf-8', errors = 'ignore').split('\0')
+    values = dict(field.split('=', 1) for field in fields[1:] if '=' in field)
+    if values.get("SUBSYSTEM") not in ["tty", "usb"] or "DEVPATH" not in values:
+      return
+
+    path = os.path.join(self.sysfs_root, values["DEVPATH"].lstrip("/"))
+    with self.lock:
+      if values.get("ACTION") == "remove":
+        for entry_path in [entry_path for entry_path in self.entries
+            if entry_path == path or entry_path.startswith(path + "/")]:
+          self.remove(entry_path)
+      elif values.get("ACTION") == "add":
+        if values["SUBSYSTEM"] == "tty":
+          entry = self.read_tty(os.path.basename(path))
+        else:
+          entry = self.read_usb_device(path)
+        if entry is not None:
+          self.add(entry)
+      else:
+        return
+    self.save()
+
+  def monitor(self):
+    """Follows kernel uevents in a background thread."""
+    monitor_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    monitor_socket.bind((0, 1))
+    def follow():
+      while True:
+        self.handle_uevent(monitor_socket.recv(65536))
+    threading.Thread(target = follow, name = "uevent-monitor", daemon = True).start()
+
+device_index = None
+device_index_lock = threading.Lock()
+
+def get_device_index():
+  global device_index
+  with device_index_lock:
+    if device_index is None or device_index.sysfs_root != usb_settings.sysfs_root:
+      device_index = DeviceIndex(usb_settings.sysfs_root, os.path.join(get_cache_directory(), "devices.json"))
+      if not device_index.load():
+        device_index.scan()
+    return device_index
+
+def resolve_serial_device(json_serial):
+  """Returns json_serial with 'device' set from its udev 'match' when it has one."""
+  if 'match' not in json_serial.keys():
+    return json_serial
+  resolved = dict(json_serial)
+  resolved['device'] = get_device_index().lookup("tty", json_serial['match'])
+  return resolved
+
+def get_usb_address(json_usb):
+  if 'hub-match' not in json_usb.keys():
+    return json_usb['usb-address']
+  return get_device_index().lookup("hub", json_usb['hub-match'])
+
+def do_power_usb(action, json_power, log_directory, run = None):
+  usb_address = get_usb_address(json_power)
+  usb_ports = get_usb_ports(json_power)
+  if usb_settings.backend != "uhubctl":
+    port_paths = get_sysfs_usb_port_paths(usb_address, usb_ports)
+    if port_paths is not None:
+      with tracer.span("usb-sysfs", hub = usb_address, ports = usb_ports):
+        return set_usb_ports_sysfs(action, usb_address, port_paths)
+    if usb_settings.backend == "sysfs":
+      raise RuntimeError("Ports {} of hub {} cannot be switched through {}".format(', '.join(usb_ports),
+        usb_address, usb_settings.sysfs_root))
+
+  execute = 'uhubctl -a {} -l {} -p {}'.format(action, usb_address, ','.join(usb_ports))
   io_list = []
   io_list.append({ "expect" : {"text" : 'Sent power {} request'.format(action)}})
-  io_list.append({ "expect" : {"text" : 'New status for hub {}'.format(json_power['usb-address'])}})
-
-  if action == "off":
-    io_list.append({ "expect" : { "text" : '  Port {}: 0000 {}'.format(json_power['usb-port'], action)}})
-  if action == "on":
-    io_list.append({ "expect" : { "text" : '  Port {}: [0-9]{{4}} power'.format(json_power['usb-port']),
-      "match-type" : "re"}})
+  io_list.append({ "expect" : {"text" : 'New status for hub {}'.format(usb_address)}})
+
+  # uhubctl reports the new status of the ports in ascending order.
+  for usb_port in sorted(usb_ports, key = lambda port: (len(port), port)):
+    if action == "off":
+      io_list.append({ "expect" : { "text" : '  Port {}: 0000 {}'.format(usb_port, action)}})
+    if action == "on":
+      io_list.append({ "expect" : { "text" : '  Port {}: [0-9]{{4}} power'.format(usb_port),
+        "match-type" : "re"}})
   json_action_command = {"execute" : execute, "io" : io_list}
-  do_host_command(json_action_command, log_directory)
-
-def do_power_command(action, json_power, log_directory):
-  check_command(json_power)
+  do_host_command(json_action_command, log_directory, run)
+
+def get_command_steps(json_action_commands):
+  """Splits a command list into steps: consecutive "parallel" entries form one step."""
+  steps = []
+  for json_action_command in json_action_commands:
+    if json_action_command.get("parallel", False) and steps and steps[-1][0].get("parallel", False):
+      steps[-1].append(json_action_command)
+    else:
+      steps.append([json_action_command])
+  return steps
+
+def do_host_command_step(json_action_command, log_directory, run, json_retry = None):
+  start = time.time()
+  run_with_retry(json_action_command.get("retry", json_retry), json_action_command.get("execute"),
+    lambda: do_host_command(json_action_command, log_directory, run), run)
+  timing_history.record(get_step_key("host", "", json_action_command), time.time() - start)
+
+def do_parallel_host_commands(json_action_commands, log_directory, run, json_retry = None):
+  failures = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers = len(json_action_commands)) as executor:
+    futures = {executor.submit(do_host_command_step, json_action_command, log_directory, run, json_retry) :
+      json_action_command["execute"] for json_action_command in json_action_commands}
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        future.result()
+      except Exception as e:
+        failures.append("{}: {}".format(futures[future], e))
+        run.cancel()
+
+  if failures:
+    raise RuntimeError("Failed parallel host commands:\n{}".format('\n'.join(failures)))
+
+def do_power_command(action, json_power, log_directory, run = None):
+  if run is None:
+    run = PowerRun()
 
   if action in json_power["command"]:
-    for json_action_command in json_power["command"][action]:
-      do_host_command(json_action_command, log_directory)
-
-def parse_power(json_communication_method, action, log_directory):
-  check_device_type(json_communication_method)
-  if json_communication_method['type'] == 'serial':
-    do_power_serial(action, json_communication_method, log_directory)
-  elif json_communication_method['type'] == 'usb':
-    do_power_usb(action, json_communication_method, log_directory)
-  elif json_communication_method['type'] == 'host':
-    do_power_command(action, json_communication_method, log_directory)
+    for step in get_command_steps(json_power["command"][action]):
+      if len(step) == 1:
+        do_host_command_step(step[0], log_directory, run, json_power.get("retry"))
+      else:
+        with tracer.span("parallel-commands", count = len(step)):
+          do_parallel_host_commands(step, log_directory, run, json_power.get("retry"))
+
+def parse_power(power_method, action, log_directory, run = None):
+  if run is None:
+    run = PowerRun()
+
+  if power_method.type in ['serial', 'usb']:
+    with get_resource_semaphore(power_method.resource, run.max_per_resource), \
+        hold_resource_lock(power_method.resource):
+      run.check_cancelled()
+      start = time.time()
+      with tracer.span("power-" + power_method.type, action = action, resource = power_method.resource):
+        if power_method.type == 'serial':
+          do_power_serial(action, power_method.json, log_directory, run)
+        else:
+          run_with_retry(power_method.json.get("retry"), "usb {} {}".format(power_method.resource, action),
+            lambda: do_power_usb(action, power_method.json, log_directory, run), run)
+      timing_history.record(get_step_key(power_method.type, action, power_method.json), time.time() - start)
+  elif power_method.type == 'host':
+    with tracer.span("power-host", action = action):
+      do_power_command(action, power_method.json, log_directory, run)
   else:
-    raise RuntimeError("type {} is not supported".format(json_communication_method['type']))
-
-def parse_power_optional(json_communication_method, action, optional_power, log_directory):
-  optional_json_data = {}
+    raise RuntimeError("type {} is not supported".format(power_method.type))
+
+optional_power_cache = {}
+optional_power_cache_lock = threading.Lock()
+
+def get_optional_power_methods(optional_power):
+  """Compiles the optional power data once per argument (json or file) into {id: [PowerMethod]}."""
+  key = (optional_power, os.stat(optional_power).st_mtime_ns if os.path.isfile(optional_power) else None)
+  with optional_power_cache_lock:
+    if key in optional_power_cache:
+      return optional_power_cache[key]
+
+  methods = {}
+  for option, json_methods in load_json_argument(optional_power).items():
+    methods[option] = []
+    for option_power_method in json_methods:
+      option_method = compile_power_method(option_power_method)
+      if option_method.type in ['optional', 'group']:
+        raise RuntimeError("type {} is not supported in optional power data".format(option_method.type))
+      methods[option].append(option_method)
+
+  with optional_power_cache_lock:
+    optional_power_cache[key] = methods
+  return methods
+
+def parse_power_optional(power_method, action, optional_power, log_directory, run = None):
   if not optional_power:
-    print("skipped option {} because no data passed about it".format(json_communication_method['id']))
-  elif os.path.exists(optional_power):
-    with open(optional_power) as f:
-      optional_json_data = json.load(f)
-  else:
-    optional_json_data = json.loads(optional_power)
-
-  for option in optional_json_data.keys():
-    if option == json_communication_method['id']:
-      print('found option for id: {}'.format(option))
-      for option_power_method in optional_json_data[option]:
-        parse_power(option_power_method, action, log_directory)
+    print("skipped option {} because no data passed about it".format(power_method.id))
+    return
 
-def do_power(appliance, action, json_conf, log_directory, optional_power = None,):
-  appliance_section = 'power'
+  option_methods = get_optional_power_methods(optional_power)
+  if power_method.id in option_methods:
+    print('found option for id: {}'.format(power_method.id))
+    for option_method in option_methods[power_method.id]:
+      parse_power(option_method, action, log_directory, run)
 
-  check_applicance(appliance, json_conf)
-  json_appliance = json_conf[appliance]
-  check_appliance_section(appliance_section, json_appliance)
-  json_appliance_section = json_appliance[appliance_section]
+def do_power_group(power_method, action, config, log_directory, optional_power, run):
+  devices = power_method.devices
+  stages = list(power_method.stages)
+  if action == "off":
+    stages.reverse()
+
+  group_start = time.time()
+  # Every device this group powered, in order, to roll back when a later one fails.
+  powered = []
+  for stage_index, stage in enumerate(stages):
+    stage_start = time.time()
+    with tracer.span("group-stage", devices = stage, action = action):
+      if run.jobs == 1 or len(stage) == 1:
+        failures = do_power_sequence(stage, action, config, log_directory, optional_power, run, powered)
+      else:
+        failures = do_power_stage(stage, action, config, log_directory, optional_power, run, powered)
+      if failures:
+        if run.rollback and action == "on":
+          rollback_group(powered, config, log_directory, optional_power, run)
+        raise RuntimeError("Failed to power {} group devices:\n{}".format(action, '\n'.join(failures)))
+    print("Stage {}/{} [{}] powered {} in {:.2f} s".format(stage_index + 1, len(stages),
+      ', '.join(stage), action, time.time() - stage_start))
+
+  print("Group [{}] powered {} in {:.2f} s".format(', '.join(devices), action, time.time() - group_start))
+
+def do_power_sequence(stage, action, config, log_directory, optional_power, run, powered):
+  for device in stage:
+    try:
+      if do_power(device, action, config, log_directory, optional_power, run):
+        powered.append(device)
+    except Exception as e:
+      return ["{}: {}".format(device, e)]
+  return []
+
+def do_power_stage(stage, action, config, log_directory, optional_power, run, powered):
+  failures = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers = min(run.jobs, len(stage))) as executor:
+    futures = {executor.submit(do_power, device, action, config, log_directory, optional_power, run) : device
+      for device in stage}
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        if future.result():
+          powered.append(futures[future])
+      except Exception as e:
+        failures.append("{}: {}".format(futures[future], e))
+        run.cancel()
+  return failures
+
+def rollback_group(powered, config, log_directory, optional_power, run):
+  for device in reversed(powered):
+    print("Rolling back {}".format(device))
+    try:
+      do_power(device, "off", config, log_directory, optional_power, run.fork())
+    except Exception as e:
+      print("Rollback of {} failed: {}".format(device, e))
 
-  for json_communication_method in json_appliance_section:
-    if json_communication_method['type'] == 'optional':
-      parse_power_optional(json_communication_method, action, optional_power, log_directory)
-    elif json_communication_method['type'] == 'group':
-      devices = get_power_group(json_communication_method)
-      for device in devices:
-        do_power(device, action, json_conf, log_directory, optional_power)
+def do_power(appliance, action, config, log_directory, optional_power = None, run = None):
+  """Powers appliance. Returns False when this run already powered it, True otherwise."""
+  appliance_section = 'power'
+  if run is None:
+    run = PowerRun()
+
+  check_applicance(appliance, config)
+  compiled_appliance = config.appliances[appliance]
+  host = get_appliance_host(compiled_appliance.json, run)
+  if host is None:
+    check_appliance_section(appliance_section, compiled_appliance.json)
+
+  claim = run.claims.claim(appliance, action)
+  if claim is None:
+    print("{} already powered {} in this run".format(appliance, action))
+    return False
+
+  try:
+    with tracer.span("power", appliance = appliance, action = action):
+      if host is not None:
+        do_remote_power(host, appliance, action, optional_power, run)
+      else:
+        do_power_methods(compiled_appliance, action, config, log_directory, optional_power, run)
+    return True
+  except Exception as e:
+    claim["error"] = str(e)
+    raise
+  finally:
+    claim["done"].set()
+
+def probe_power_state(compiled_appliance):
+  if "status" not in compiled_appliance.json.keys():
+    return None
+
+  json_status = compiled_appliance.json["status"]
+  with tracer.span("status-probe", appliance = compiled_appliance.name):
+    try:
+      result = subprocess.run(["bash", "-c", json_status["execute"]], stdout = subprocess.PIPE,
+        stderr = subprocess.STDOUT, timeout = float(json_status.get("timeout", 10)))
+    except subprocess.TimeoutExpired:
+      return None
+
+  if "expect-on" in json_status.keys():
+    output = result.stdout.decode('utf-8', errors = 'ignore')
+    return "on" if re.search(json_status["expect-on"], output) else "off"
+  return "on" if result.returncode == 0 else "off"
+
+def is_in_power_state(compiled_appliance, action, run):
+  if run.force:
+    return False
+
+  state = probe_power_state(compiled_appliance)
+  if state is None and run.trust_state and run.state_store is not None:
+    state = run.state_store.get(compiled_appliance.name)
+  return state == action
+
+def do_power_methods(compiled_appliance, action, config, log_directory, optional_power, run):
+  own_methods = [power_method for power_method in compiled_appliance.power if power_method.type != 'group']
+  skip_own_methods = len(own_methods) > 0 and is_in_power_state(compiled_appliance, action, run)
+  if skip_own_methods:
+    print("{} is already {}, skipping".format(compiled_appliance.name, action))
+    run.unchanged.append(compiled_appliance.name)
+
+  try:
+    for power_method in compiled_appliance.power:
+      run.check_cancelled()
+      if power_method.type == 'group':
+        do_power_group(power_method, action, config, log_directory, optional_power, run)
+      elif skip_own_methods:
+        continue
+      elif power_method.type == 'optional':
+        parse_power_optional(power_method, action, optional_power, log_directory, run)
+      else:
+        parse_power(power_method, action, log_directory, run)
+  except Exception:
+    if own_methods and not skip_own_methods and run.state_store is not None:
+      run.state_store.set(compiled_appliance.name, "unknown")
+    raise
+
+  if own_methods and not skip_own_methods:
+    run.changed.append(compiled_appliance.name)
+    if run.state_store is not None:
+      run.state_store.set(compiled_appliance.name, action)
+
+def load_json_argument(json_argument):
+  if os.path.exists(json_argument):
+    with open(json_argument) as f:
+      return json.load(f)
+  return json.loads(json_argument)
+
+def parse_batch_plan(json_plan):
+  if isinstance(json_plan, dict):
+    return [{"appliance" : appliance, "action" : action} for appliance, action in json_plan.items()]
+
+  targets = []
+  for json_target in json_plan:
+    if not intersect(["appliance", "action"], json_target.keys()):
+      raise RuntimeError("'appliance' and 'action' are mandatory for each batch target")
+    targets.append({"appliance" : json_target["appliance"], "action" : json_target["action"]})
+  return targets
+
+def check_batch_targets(targets, config):
+  actions = {}
+  for target in targets:
+    check_applicance(target["appliance"], config)
+    if target["action"] not in ["on", "off"]:
+      raise RuntimeError("Invalid action {} for {}".format(target["action"], target["appliance"]))
+    if actions.setdefault(target["appliance"], target["action"]) != target["action"]:
+      raise RuntimeError("Conflicting actions requested for {}".format(target["appliance"]))
+
+def do_power_target(target, config, log_directory, optional_power, run):
+  result = {"appliance" : target["appliance"], "action" : target["action"]}
+  start = time.time()
+  try:
+    do_power(target["appliance"], target["action"], config, log_directory, optional_power, run)
+    result["status"] = "ok"
+  except Exception as e:
+    result["status"] = "error"
+    result["error"] = str(e)
+  result["duration"] = round(time.time() - start, 3)
+  result["changed"] = run.changed
+  result["unchanged"] = run.unchanged
+  result["retries"] = run.retries
+  return result
+
+def do_power_batch(targets, config, log_directory, optional_power = None, run = None):
+  if run is None:
+    run = PowerRun()
+  check_batch_targets(targets, config)
+
+  # Drop repeated targets; serial sessions and device semaphores already coalesce shared hardware.
+  unique_targets = []
+  for target in targets:
+    if target not in unique_targets:
+      unique_targets.append(target)
+
+  # Targets are unrelated: a failure does not cancel the others, but a device shared by
+  # several targets is still powered only once.
+  with concurrent.futures.ThreadPoolExecutor(max_workers = run.jobs) as executor:
+    futures = [executor.submit(do_power_target, target, config, log_directory, optional_power,
+      run.fork(run.claims)) for target in unique_targets]
+    return [future.result() for future in futures]
+
+class PowerPlanner(object):
+  """Expands a power request into the flat graph of steps do_power would run, without running them.
+
+  Steps depend on the steps that must finish before them. Estimates come from the timings of
+  past runs; the schedule serializes steps on the same relay board or hub like the resource
+  semaphores do.
+  """
+  def __init__(self, config, optional_power = None, jobs = 1, max_per_resource = 1):
+    self.config = config
+    self.optional_power = optional_power
+    self.jobs = max(1, jobs)
+    self.max_per_resource = max(1, max_per_resource)
+    self.steps = []
+    self.planned = {}
+
+  def add_step(self, appliance, action, step_type, resource, key, commands, after):
+    step = {"id" : len(self.steps), "appliance" : appliance, "action" : action, "type" : step_type,
+      "resource" : resource, "commands" : commands, "after" : sorted(set(after)),
+      "estimate" : timing_history.estimate(key) if key is not None else None}
+    if "status" in self.config.appliances[appliance].json.keys():
+      step["skipped-if-status"] = action
+    self.steps.append(step)
+    return [step["id"]]
+
+  def add_appliance(self, appliance, action, after):
+    check_applicance(appliance, self.config)
+    if (appliance, action) in self.planned:
+      return self.planned[(appliance, action)]
+
+    compiled_appliance = self.config.appliances[appliance]
+    host = get_appliance_host(compiled_appliance.json)
+    if host is not None:
+      terminals = self.add_step(appliance, action, "remote", "agent:{}".format(host), None,
+        ["forward power {} to {}".format(action, host)], after)
     else:
-      parse_power(json_communication_method, action, log_directory)
+      terminals = list(after)
+      for power_method in compiled_appliance.power:
+        if power_method.type == 'group':
+          terminals = self.add_group(power_method, action, terminals)
+        elif power_method.type == 'optional':
+          option_methods = get_optional_power_methods(self.optional_power) if self.optional_power else {}
+          for option_method in option_methods.get(power_method.id, []):
+            terminals = self.add_method(appliance, option_method, action, terminals)
+        else:
+          terminals = self.add_method(appliance, power_method, action, terminals)
+
+    self.planned[(appliance, action)] = terminals
+    return terminals
+
+  def add_group(self, power_method, action, after):
+    stages = list(power_method.stages)
+    if action == "off":
+      stages.reverse()
+    for stage in stages:
+      if self.jobs == 1:
+        for device in stage:
+          after = self.add_appliance(device, action, after)
+      else:
+        stage_terminals = []
+        for device in stage:
+          stage_terminals += self.add_appliance(device, action, after)
+        after = stage_terminals
+    return after
+
+  def add_method(self, appliance, power_method, action, after):
+    json_power = power_method.json
+    key = get_step_key(power_method.type, action, json_power)
+    if power_method.type == 'serial':
+      if action not in json_power["command"]:
+        return after
+      commands = []
+      for json_action_command in json_power["command"][action]:
+        for io in json_action_command["io"]:
+          if "send" in io.keys():
+            commands.append("send {!r}".format(io["send"]))
+          if "expect" in io.keys():
+            commands.append("expect {!r} within {} s".format(io["expect"]["text"], io["expect"].get("timeout", 2)))
+      return self.add_step(appliance, action, "serial", power_method.resource, key, commands, after)
+    elif power_method.type == 'usb':
+      return self.add_step(appliance, action, "usb", power_method.resource, key,
+        self.get_usb_commands(json_power, action), after)
+
+    terminals = after
+    for step in get_command_steps(json_power["command"].get(action, [])):
+      step_terminals = []
+      for json_action_command in step:
+        step_terminals += self.add_step(appliance, action, "host", None, get_step_key("host", "", json_action_command),
+          [json_action_command.get("execute", "")], terminals)
+      terminals = step_terminals
+    return terminals
+
+  def get_usb_commands(self, json_power, action):
+    usb_ports = get_usb_ports(json_power)
+    try:
+      usb_address = get_usb_address(json_power)
+    except RuntimeError as e:
+      return ["unresolved hub: {}".format(e)]
+    if usb_settings.backend != "uhubctl":
+      port_paths = get_sysfs_usb_port_paths(usb_address, usb_ports)
+      if port_paths is not None:
+        return ["echo {} > {}".format(1 if action == "off" else 0, os.path.join(port_path, "disable"))
+          for port_path in port_paths.values()]
+    return ['uhubctl -a {} -l {} -p {}'.format(action, usb_address, ','.join(usb_ports))]
+
+  def get_ancestors(self):
+    ancestors = []
+    for step in self.steps:
+      step_ancestors = set(step["after"])
+      for dependency in step["after"]:
+        step_ancestors |= ancestors[dependency]
+      ancestors.append(step_ancestors)
+    return ancestors
+
+  def summarize(self):
+    levels = []
+    resource_slots = {}
+    ends = []
+    for step in self.steps:
+      step["level"] = max([self.steps[dependency]["level"] + 1 for dependency in step["after"]] or [0])
+      if step["level"] == len(levels):
+        levels.append([])
+      levels[step["level"]].append(step["id"])
+
+      start = max([ends[dependency] for dependency in step["after"]] or [0])
+      if step["resource"] is not None and step["type"] != "remote":
+        slots = resource_slots.setdefault(step["resource"], [0] * self.max_per_resource)
+        slot = slots.index(min(slots))
+        start = max(start, slots[slot])
+      ends.append(start + (step["estimate"] or 0))
+      if step["resource"] is not None and step["type"] != "remote":
+        slots[slot] = ends[-1]
+      step["start"] = round(start, 3)
+      if step["estimate"] is not None:
+        step["estimate"] = round(step["estimate"], 3)
+
+    ancestors = self.get_ancestors()
+    contention = {}
+    for step in self.steps:
+      if step["resource"] is None or step["type"] == "remote":
+        continue
+      for other in self.steps[:step["id"]]:
+        if other["resource"] == step["resource"] and other["id"] not in ancestors[step["id"]]:
+          contention.setdefault(step["resource"], set()).update([other["id"], step["id"]])
+
+    return {"steps" : self.steps, "levels" : levels,
+      "contention" : {resource : sorted(ids) for resource, ids in contention.items()},
+      "estimate" : {"duration" : round(max(ends or [0]), 3),
+        "sequential" : round(sum(step["estimate"] or 0 for step in self.steps), 3),
+        "unknown-steps" : len([step for step in self.steps if step["estimate"] is None])}}
+
+def plan_request(request, config):
+  if request["command"] == "power":
+    targets = [{"appliance" : request["appliance"], "action" : request["action"]}]
+  elif request["command"] == "batch":
+    targets = request["targets"]
+  else:
+    raise RuntimeError("--plan applies to power, batch and reconcile commands")
 
-def get_serial_device(appliance, appliance_section, json_conf):
+  planner = PowerPlanner(config, request.get("optional-power"), request.get("jobs", 1),
+    request.get("max-per-resource", 1))
+  for target in targets:
+    planner.add_appliance(target["appliance"], target["action"], [])
+  return planner.summarize()
+
+def get_serial_device(appliance, appliance_section, config):
   found_serial = False
   device_data_result = None
-  check_applicance(appliance, json_conf)
-  json_appliance = json_conf[appliance]
+  check_applicance(appliance, config)
+  json_appliance = config.appliances[appliance].json
 
   check_appliance_section(appliance_section, json_appliance)
   json_appliance_section = json_appliance[appliance_section]
@@ -278,27 +1927,851 @@ def get_serial_device(appliance, appliance_section, json_conf):
   if not found_serial:
     raise RuntimeError("Cannot get serial device for a non serial appliance section")
 
-  return device_data_result
+  return resolve_serial_device(device_data_result)
 
-def expect_on_serial(appliance, json_expect, json_conf):
-  json_serial = get_serial_device(appliance, "communications", json_conf)
+def expect_on_serial(appliance, json_expect, config, capture_directory = None, log_directory = "/tmp",
+    run = None, output = None):
+  """Matches json_expect on the console of appliance. output, when given, is called with the
+  console data as it is read."""
+  check_applicance(appliance, config)
   check_json_expect(json_expect)
-
-  serial_cmd = "socat -t0 STDIO,raw,echo=0,escape=0x03,nonblock=1 file:{},b{},cs8,parenb=0,cstopb=0,clocal=0,raw,echo=0".format(json_serial['device'], json_serial['baud'])
-
-  timestr = time.strftime("%Y%m%d-%H%M%S")
-  log_file_name = "/tmp/lab-controller-serial-{}{}.log".format(json_serial["device"],timestr)
-  with open(log_file_name, 'wb') as logfile:
-    serial_conn = pexpect.spawnu(serial_cmd, timeout=2, env=os.environ, codec_errors='ignore', logfile=logfile)
-
+  host = get_appliance_host(config.appliances[appliance].json, run)
+  if host is not None:
+    with tracer.span("remote-expect-on-serial", appliance = appliance, host = host):
+      return agent_pool.request(host, {"command" : "expect-on-serial", "appliance" : appliance,
+        "expect" : json_expect, "forwarded" : True}, output or echo_remote_output)
+
+  json_serial = get_serial_device(appliance, "communications", config)
+  if capture_directory:
+    device_capture_directory = get_device_capture_directory(capture_directory, json_serial['device'])
+    if is_capture_running(device_capture_directory):
+      return do_expect_on_capture(json_serial, json_expect, device_capture_directory, run, output)
+
+  with get_resource_semaphore(get_power_resource(json_serial), 1), \
+      hold_resource_lock(get_power_resource(json_serial)), \
+      tracer.span("expect-on-serial", appliance = appliance, device = json_serial['device']):
+    do_expect_on_serial(json_serial, json_expect, log_directory, run, output)
+
+def do_expect_on_serial(json_serial, json_expect, log_directory = "/tmp", run = None, output = None):
+  def reset(serial_conn):
     if "reset-prompt" in json_serial.keys():
       serial_conn.send(json_serial["reset-prompt"])
       if "reset-expect" in json_serial.keys():
-        serial_conn.expect(json_serial["reset-expect"])
+        do_expect(serial_conn, json_serial["reset-expect"], "re", run = run)
+
+  log_name = "serial-{}".format(os.path.basename(json_serial["device"]))
+  with open_command_log(log_directory, log_name, False, output) as logfile:
+    do_on_serial(json_serial, logfile, reset, flush = True)
+    for expect_entry in json_expect["expect"]:
+      run_with_retry(expect_entry.get("retry"), "expect {}".format(expect_entry["text"]),
+        lambda: do_on_serial(json_serial, logfile, lambda serial_conn: do_expect_attempt(serial_conn, expect_entry,
+          "re", run)), run)
+
+def get_ready_plan(json_plan):
+  """Accepts {"appliance": {"expect": [...]}} or {"appliance": [...]} and returns the former."""
+  if not isinstance(json_plan, dict) or len(json_plan) == 0:
+    raise RuntimeError("The readiness plan must map at least one appliance to its expect list")
+  return {appliance : json_expect if isinstance(json_expect, dict) else {"expect" : json_expect}
+    for appliance, json_expect in json_plan.items()}
+
+def wait_ready(json_plan, config, quorum = None, capture_directory = None, log_directory = "/tmp"):
+  """Waits in parallel for the consoles of several appliances.
+
+  Returns once quorum appliances (all by default) matched their expect list, or once
+  the quorum can no longer be reached. The remaining waits are then cancelled.
+  """
+  plan = get_ready_plan(json_plan)
+  for appliance, json_expect in plan.items():
+    check_applicance(appliance, config)
+    if get_appliance_host(config.appliances[appliance].json) is None:
+      get_serial_device(appliance, "communications", config)
+    check_json_expect(json_expect)
+
+  quorum = len(plan) if quorum is None else quorum
+  if quorum < 1 or quorum > len(plan):
+    raise RuntimeError("Quorum must be between 1 and {}".format(len(plan)))
+
+  run = PowerRun()
+  results = {}
+  start = time.time()
+  with tracer.span("wait-ready", appliances = len(plan), quorum = quorum), \
+      concurrent.futures.ThreadPoolExecutor(max_workers = len(plan)) as executor:
+    futures = {executor.submit(expect_on_serial, appliance, json_expect, config, capture_directory,
+      log_directory, run) : appliance for appliance, json_expect in plan.items()}
+    for future in concurrent.futures.as_completed(futures):
+      appliance = futures[future]
+      try:
+        future.result()
+        results[appliance] = {"status" : "ready", "time-to-ready" : round(time.time() - start, 3)}
+      except Exception as e:
+        status = "cancelled" if run.cancelled.is_set() else "error"
+        results[appliance] = {"status" : status, "error" : str(e).split("\n")[0]}
+
+      ready = len([result for result in results.values() if result["status"] == "ready"])
+      failed = len(results) - ready
+      if not run.cancelled.is_set() and (ready >= quorum or len(plan) - failed < quorum):
+        run.cancel()
+
+  return {"ready" : ready, "quorum" : quorum, "duration" : round(time.time() - start, 3),
+    "appliances" : results}
+
+CAPTURE_INDEX_INTERVAL = 0.5
+
+def get_device_capture_directory(capture_directory, device):
+  return os.path.join(capture_directory, os.path.basename(device))
+
+def is_capture_running(device_capture_directory):
+  lock_path = os.path.join(device_capture_directory, "capture.lock")
+  if not os.path.exists(lock_path):
+    return False
+  with open(lock_path) as lock_file:
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+      return True
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+  return False
+
+def list_capture_segments(device_capture_directory):
+  segments = []
+  for name in os.listdir(device_capture_directory):
+    if name.startswith("segment-") and name.endswith(".log"):
+      segments.append((int(name[len("segment-"):-len(".log")]), os.path.join(device_capture_directory, name)))
+  return sorted(segments)
+
+class ConsoleCapture(object):
+  """Records a serial console into rotating, time indexed segments.
+
+  Segments are named after the stream offset of their first byte and each has
+  an .idx companion with "<time> <offset>" lines, so readers can start from an
+  offset or a point in time without touching the tty.
+  """
+  def __init__(self, device_capture_directory, device, baud, segment_size, segment_count):
+    self.directory = device_capture_directory
+    self.device = device
+    self.baud = baud
+    self.segment_size = segment_size
+    self.segment_count = segment_count
+    self.offset = 0
+    self.segment = None
+    self.segment_written = 0
+    self.index = None
+    self.last_index_time = 0
+
+  def rotate(self):
+    if self.segment is not None:
+      self.segment.close()
+      self.index.close()
+
+    segment_path = os.path.join(self.directory, "segment-{:016d}.log".format(self.offset))
+    self.segment = open(segment_path, 'wb')
+    self.index = open(segment_path[:-len(".log")] + ".idx", 'w')
+    self.segment_written = 0
+    self.last_index_time = 0
+
+    for _, old_segment_path in list_capture_segments(self.directory)[:-self.segment_count]:
+      os.unlink(old_segment_path)
+      if os.path.exists(old_segment_path[:-len(".log")] + ".idx"):
+        os.unlink(old_segment_path[:-len(".log")] + ".idx")
+
+  def write(self, data):
+    if self.segment is None or self.segment_written >= self.segment_size:
+      self.rotate()
+
+    now = time.time()
+    if now - self.last_index_time >= CAPTURE_INDEX_INTERVAL:
+      self.index.write("{:.3f} {}\n".format(now, self.offset))
+      self.index.flush()
+      self.last_index_time = now
+
+    self.segment.write(data)
+    self.segment.flush()
+    self.segment_written += len(data)
+    self.offset += len(data)
+
+  def run(self, stop_event):
+    os.makedirs(self.directory, exist_ok = True)
+    with open(os.path.join(self.directory, "capture.lock"), 'w') as lock_file:
+      try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        raise RuntimeError("{} is already being captured in {}".format(self.device, self.directory))
+
+      segments = list_capture_segments(self.directory)
+      if segments:
+        self.offset = segments[-1][0] + os.path.getsize(segments[-1][1])
+
+      print("Capturing {} in {}".format(self.device, self.directory))
+      fd = None
+      while not stop_event.is_set():
+        if fd is None:
+          try:
+            fd = open_serial_fd(self.device, self.baud, os.O_RDONLY)
+          except RuntimeError:
+            # The console disappears while its board is powered off.
+            stop_event.wait(1)
+            continue
+
+        readable, _, _ = select.select([fd], [], [], 1)
+        if not readable:
+          continue
+        try:
+          data = os.read(fd, 65536)
+        except OSError:
+          data = b''
+        if data:
+          self.write(data)
+        else:
+          os.close(fd)
+          fd = None
+
+      if fd is not None:
+        os.close(fd)
+      if self.segment is not None:
+        self.segment.close()
+        self.index.close()
+
+def run_capture(config, appliances, capture_directory, segment_size, segment_count):
+  captures = {}
+  for appliance in appliances or config.appliances.keys():
+    check_applicance(appliance, config)
+    for json_communication in config.appliances[appliance].json.get('communications', []):
+      if json_communication['type'] == 'serial':
+        json_communication = resolve_serial_device(json_communication)
+        captures[json_communication['device']] = ConsoleCapture(
+          get_device_capture_directory(capture_directory, json_communication['device']),
+          json_communication['device'], json_communication['baud'], segment_size, segment_count)
+
+  if not captures:
+    raise RuntimeError("No serial communications devices to capture")
+
+  stop_event = threading.Event()
+  signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+  threads = [threading.Thread(target = capture.run, args = (stop_event,), daemon = True)
+    for capture in captures.values()]
+  for thread in threads:
+    thread.start()
+  try:
+    while any(thread.is_alive() for thread in threads):
+      for thread in threads:
+        thread.join(0.5)
+  except KeyboardInterrupt:
+    stop_event.set()
+
+class CaptureReader(object):
+  """Follows a console capture from a stream offset.
+
+  Exposes buffer and read_nonblocking so stream_expect can match on it as on
+  any pexpect connection. Segments are read through mmap.
+  """
+  def __init__(self, device_capture_directory, position, output = None):
+    self.directory = device_capture_directory
+    self.position = position
+    self.output = output
+    self.buffer = ''
+    self.decoder = codecs.getincrementaldecoder('utf-8')(errors = 'ignore')
+
+  def read_available(self, size):
+    segments = list_capture_segments(self.directory)
+    if not segments:
+      return b''
+    if self.position < segments[0][0]:
+      print("Capture of {} rotated past offset {}, continuing at {}".format(self.directory,
+        self.position, segments[0][0]))
+      self.position = segments[0][0]
+
+    for index, (start, path) in enumerate(segments):
+      next_start = segments[index + 1][0] if index + 1 < len(segments) else None
+      if next_start is not None and self.position >= next_start:
+        continue
+      with open(path, 'rb') as segment:
+        length = os.fstat(segment.fileno()).st_size
+        if self.position - start >= length:
+          if next_start is not None:
+            self.position = next_start
+            continue
+          return b''
+        with mmap.mmap(segment.fileno(), length, access = mmap.ACCESS_READ) as mapped:
+          data = mapped[self.position - start:min(length, self.position - start + size)]
+      self.position += len(data)
+      return data
+    return b''
+
+  def read_nonblocking(self, size = 1, timeout = None):
+    deadline = time.time() + (timeout if timeout is not None else 0)
+    while True:
+      data = self.decoder.decode(self.read_available(size))
+      if data:
+        if self.output is not None:
+          self.output(data)
+        return data
+      if time.time() >= deadline:
+        raise pexpect.TIMEOUT("No new data in capture {}".format(self.directory))
+      time.sleep(0.05)
+
+  def send(self, text):
+    raise RuntimeError("Cannot send on a console capture")
+
+  def get_consumed_position(self):
+    return self.position - len(self.buffer.encode('utf-8'))
+
+def get_capture_position(device_capture_directory, json_from):
+  segments = list_capture_segments(device_capture_directory)
+  end = segments[-1][0] + os.path.getsize(segments[-1][1]) if segments else 0
+  if json_from is None or json_from == "now":
+    return end
+  if json_from == "start":
+    return segments[0][0] if segments else 0
+  if isinstance(json_from, dict) and "offset" in json_from:
+    return int(json_from["offset"])
+
+  from_time = float(json_from)
+  for _, segment_path in segments:
+    with open(segment_path[:-len(".log")] + ".idx") as index:
+      for line in index:
+        entry_time, entry_offset = line.split()
+        if float(entry_time) >= from_time:
+          return int(entry_offset)
+  return end
+
+def do_expect_on_capture(json_serial, json_expect, device_capture_directory, run = None, output = None):
+  reader = CaptureReader(device_capture_directory,
+    get_capture_position(device_capture_directory, json_expect.get("from")), output)
+
+  if "reset-prompt" in json_serial.keys():
+    fd = open_serial_fd(json_serial['device'], json_serial['baud'], os.O_WRONLY)
+    try:
+      os.write(fd, json_serial["reset-prompt"].encode('utf-8'))
+    finally:
+      os.close(fd)
+    if "reset-expect" in json_serial.keys():
+      do_expect(reader, json_serial["reset-expect"], "re", run = run)
+
+  for expect_entry in json_expect["expect"]:
+    do_expect_step(reader, expect_entry, "re", run)
+
+  return {"device" : json_serial['device'], "offset" : reader.get_consumed_position()}
+
+CONFIG_CACHE_VERSION = 5
+
+class PowerMethod(object):
+  __slots__ = ['type', 'json', 'resource', 'id', 'devices', 'stages']
+  def __init__(self, json_method):
+    self.type = json_method['type']
+    self.json = json_method
+    self.resource = None
+    self.id = None
+    self.devices = []
+    self.stages = []
+
+class Appliance(object):
+  __slots__ = ['name', 'json', 'power', 'dependencies', 'closure']
+  def __init__(self, name, json_appliance):
+    self.name = name
+    self.json = json_appliance
+    self.power = []
+    self.dependencies = []
+    self.closure = []
+
+class Config(object):
+  __slots__ = ['path', 'json', 'appliances', 'errors']
+  def __init__(self, path, json_conf):
+    self.path = path
+    self.json = json_conf
+    self.appliances = {}
+    self.errors = []
+
+def compile_power_method(json_method):
+  check_device_type(json_method)
+  power_method = PowerMethod(json_method)
+  if power_method.type == 'serial':
+    check_serial_settings(json_method)
+    check_command(json_method)
+    for action in json_method['command'].keys():
+      for json_action_command in json_method['command'][action]:
+        if "io" not in json_action_command.keys():
+          raise RuntimeError("io section required for serial devices")
+  elif power_method.type == 'usb':
+    check_usb_json(json_method)
+  elif power_method.type == 'host':
+    check_command(json_method)
+  elif power_method.type == 'group':
+    power_method.devices = list(get_power_group(json_method))
+  elif power_method.type == 'optional':
+    if 'id' not in json_method.keys():
+      raise RuntimeError("'id' is mandatory for optional power methods")
+    power_method.id = json_method['id']
+  else:
+    raise RuntimeError("type {} is not supported".format(power_method.type))
+
+  check_retry(json_method)
+  power_method.resource = get_power_resource(json_method)
+  return power_method
+
+def compile_appliance(name, json_appliance, errors):
+  if not isinstance(json_appliance, dict):
+    errors.append("{}: appliance configuration must be a dictionary".format(name))
+    return None
+
+  appliance = Appliance(name, json_appliance)
+  appliance.dependencies = get_device_dependencies(json_appliance)
+  for index, json_method in enumerate(json_appliance.get('power', [])):
+    try:
+      appliance.power.append(compile_power_method(json_method))
+    except (RuntimeError, AttributeError, TypeError) as e:
+      errors.append("{}: power method {}: {}".format(name, index, e))
+
+  if 'status' in json_appliance.keys():
+    if not isinstance(json_appliance['status'], dict) or 'execute' not in json_appliance['status'].keys():
+      errors.append("{}: 'execute' is mandatory in the status probe".format(name))
+
+  communications = json_appliance.get('communications', [])
+  if communications and not isinstance(communications, list):
+    errors.append("{}: communications must be a list".format(name))
+  elif communications:
+    for index, json_communication in enumerate(communications):
+      try:
+        check_device_type(json_communication)
+        if json_communication['type'] == 'serial':
+          check_serial_settings(json_communication)
+      except RuntimeError as e:
+        errors.append("{}: communication {}: {}".format(name, index, e))
+
+  return appliance
+
+def get_group_closure(config, name, visiting, closures):
+  if name in closures:
+    return closures[name]
+  if name in visiting:
+    raise RuntimeError("Group cycle: {}".format(' -> '.join(visiting + [name])))
+
+  closure = []
+  for power_method in config.appliances[name].power:
+    if power_method.type != 'group':
+      if name not in closure:
+        closure.append(name)
+      continue
+    for device in power_method.devices:
+      if device not in config.appliances:
+        raise RuntimeError("group device {} not found in configuration".format(device))
+      for member in get_group_closure(config, device, visiting + [name], closures):
+        if member not in closure:
+          closure.append(member)
+
+  closures[name] = closure
+  return closure
+
+def compile_config(json_conf, path = None):
+  config = Config(path, json_conf)
+  if not isinstance(json_conf, dict):
+    config.errors.append("configuration root must be a dictionary of appliances")
+    return config
+
+  for name, json_appliance in json_conf.items():
+    appliance = compile_appliance(name, json_appliance, config.errors)
+    if appliance is not None:
+      config.appliances[name] = appliance
+
+  closures = {}
+  for name, appliance in config.appliances.items():
+    for dependency in appliance.dependencies:
+      if dependency not in config.appliances:
+        config.errors.append("{}: dependency {} not found in configuration".format(name, dependency))
+    try:
+      appliance.closure = get_group_closure(config, name, [], closures)
+      for power_method in appliance.power:
+        if power_method.type == 'group':
+          power_method.stages = get_group_stages(power_method.devices, config)
+    except RuntimeError as e:
+      config.errors.append("{}: {}".format(name, e))
+
+  return config
+
+def get_cache_directory():
+  return os.environ.get("LAB_CONTROLLER_CACHE_DIR",
+    os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "lab-controller"))
+
+def get_config_cache_path(config_key):
+  config_hash = hashlib.sha1(config_key.encode('utf-8')).hexdigest()
+  return os.path.join(get_cache_directory(), "config-{}.pickle".format(config_hash))
+
+def read_config_cache(cache_path, stamp):
+  try:
+    with open(cache_path, 'rb') as cache_file:
+      if pickle.load(cache_file) != stamp:
+        return None
+      return pickle.load(cache_file)
+  except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+    return None
+
+def write_config_cache(cache_path, stamp, config):
+  try:
+    os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+    with tempfile.NamedTemporaryFile(dir = os.path.dirname(cache_path), delete = False) as cache_file:
+      pickle.dump(stamp, cache_file)
+      pickle.dump(config, cache_file)
+    os.replace(cache_file.name, cache_path)
+  except OSError as e:
+    print("Could not cache compiled configuration in {}: {}".format(cache_path, e))
+
+config_cache = {}
+config_cache_lock = threading.Lock()
+
+def load_config(json_config_path, allow_errors = False):
+  if not os.path.exists(json_config_path):
+    raise RuntimeError("Selected configuration file {} not found".format(json_config_path))
+
+  config_key = os.path.abspath(json_config_path)
+  config_stat = os.stat(config_key)
+  stamp = (CONFIG_CACHE_VERSION, config_stat.st_mtime_ns, config_stat.st_size)
+  with config_cache_lock:
+    config = config_cache[config_key][1] if config_cache.get(config_key, (None,))[0] == stamp else None
+
+  if config is None:
+    cache_path = get_config_cache_path(config_key)
+    config = read_config_cache(cache_path, stamp)
+    if config is None:
+      with open(json_config_path) as json_file:
+        config = compile_config(json.load(json_file), config_key)
+      write_config_cache(cache_path, stamp, config)
+
+    with config_cache_lock:
+      config_cache[config_key] = (stamp, config)
+
+  if config.errors and not allow_errors:
+    raise RuntimeError("Invalid configuration {}:\n{}".format(json_config_path, '\n'.join(config.errors)))
+  return config
+
+def get_request_run(request):
+  state_file = request.get("state-file", os.path.join(get_cache_directory(), "state.json"))
+  return PowerRun(request.get("jobs", 1), request.get("max-per-resource", 1), request.get("rollback", False),
+    request.get("force", False), request.get("trust-state", False), StateStore(state_file) if state_file else None,
+    forwarded = request.get("forwarded", False))
+
+def get_request_appliances(request, config):
+  if request["command"] in ["power", "expect-on-serial", "reserve"]:
+    appliances = [request["appliance"]] if request["command"] != "reserve" else request["appliances"]
+  elif request["command"] == "batch":
+    appliances = [target["appliance"] for target in request["targets"]]
+  elif request["command"] == "wait-ready":
+    appliances = list(request["plan"].keys())
+  else:
+    return []
+
+  for appliance in appliances:
+    check_applicance(appliance, config)
+  # Appliances of other lab hosts are leased by their agent.
+  return [appliance for appliance in appliances
+    if request.get("forwarded") or get_appliance_host(config.appliances[appliance].json) is None]
+
+def get_console_lease_keys(appliance, config, capture_directory = None):
+  """Expects only read the console of appliance: they need none of its other keys, and none at
+  all when the console is captured, as any number of readers can follow a capture."""
+  if capture_directory:
+    json_serial = get_serial_device(appliance, "communications", config)
+    if is_capture_running(get_device_capture_directory(capture_directory, json_serial['device'])):
+      return set()
+  return set(get_power_resource(json_communication)
+    for json_communication in config.appliances[appliance].json.get('communications', [])
+    if json_communication.get('type') == 'serial')
+
+def get_request_lease_keys(request, config):
+  keys = set()
+  for appliance in get_request_appliances(request, config):
+    if request["command"] in ["expect-on-serial", "wait-ready"]:
+      keys |= get_console_lease_keys(appliance, config, request.get("capture-directory"))
+    else:
+      keys |= get_lease_keys(appliance, config)
+  return sorted(keys)
+
+@contextlib.contextmanager
+def hold_request_leases(request, config):
+  """Holds the leases a request needs while it runs, on top of those of its reservation."""
+  keys = get_request_lease_keys(request, config)
+  if not lease_settings.directory or not keys:
+    yield
+    return
 
-    json_expect_array = json_expect["expect"]
-    for expect_entry in json_expect_array:
-      serial_conn.expect(expect_entry['text'], float(expect_entry['timeout']))
+  manager = LeaseManager(lease_settings.directory)
+  owner = request.get("lease") or new_lease_owner()
+  with tracer.span("lease-wait", keys = len(keys)) as span:
+    granted, wait = manager.acquire(keys, owner, timeout = request.get("queue-timeout"))
+    span["wait"] = round(wait, 3)
+  if wait >= lease_settings.poll_interval:
+    print("Waited {:.1f} s in the lease queue".format(wait))
+  try:
+    yield
+  finally:
+    manager.release(owner, granted)
+
+def execute_request(request, output = None):
+  """Runs a request of the command line, a daemon client or a coordinator. output, when given,
+  receives the console data of expect-on-serial as it is read."""
+  config = load_config(request["config"])
+
+  if request["command"] == "reserve":
+    if not lease_settings.directory:
+      raise RuntimeError("Leases are disabled")
+    keys = get_request_lease_keys(request, config)
+    owner = request.get("lease") or new_lease_owner()
+    _, wait = LeaseManager(lease_settings.directory).acquire(keys, owner, float(request["duration"]),
+      request.get("queue-timeout"))
+    return {"lease" : owner, "keys" : keys, "wait" : round(wait, 3),
+      "expires" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() + float(request["duration"])))}
+  elif request["command"] == "release":
+    return {"released" : LeaseManager(lease_settings.directory).release(request["lease"])}
+  elif request["command"] == "leases":
+    return LeaseManager(lease_settings.directory).list()
+  elif request.get("dry-run"):
+    return plan_request(request, config)
+
+  try:
+    with hold_request_leases(request, config):
+      return run_request(request, config, output)
+  finally:
+    timing_history.save()
+
+def run_request(request, config, output = None):
+  if request["command"] == "power":
+    do_power(request["appliance"], request["action"], config, request.get("log-directory", "/tmp"),
+      request.get("optional-power"), get_request_run(request))
+    return None
+  elif request["command"] == "batch":
+    return do_power_batch(request["targets"], config, request.get("log-directory", "/tmp"),
+      request.get("optional-power"), get_request_run(request))
+  elif request["command"] == "get-serial-device":
+    check_applicance(request["appliance"], config)
+    host = None if request.get("forwarded") else get_appliance_host(config.appliances[request["appliance"]].json)
+    if host is not None:
+      return agent_pool.request(host, {"command" : "get-serial-device", "appliance" : request["appliance"],
+        "section" : request["section"], "forwarded" : True})
+    return get_serial_device(request["appliance"], request["section"], config)
+  elif request["command"] == "expect-on-serial":
+    return expect_on_serial(request["appliance"], request["expect"], config, request.get("capture-directory"),
+      request.get("log-directory", "/tmp"), get_request_run(request), output)
+  elif request["command"] == "wait-ready":
+    return wait_ready(request["plan"], config, request.get("quorum"), request.get("capture-directory"),
+      request.get("log-directory", "/tmp"))
+  else:
+    raise RuntimeError("Unknown request command {}".format(request["command"]))
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+  """Serves json requests, one per line. Console output is streamed as {"stream": data} lines
+  before the {"status": ...} response."""
+  def send(self, message):
+    with self.lock:
+      self.wfile.write((json.dumps(message) + "\n").encode('utf-8'))
+      self.wfile.flush()
+
+  def handle(self):
+    self.lock = threading.Lock()
+    try:
+      self.handle_requests()
+    except ConnectionError:
+      pass
+
+  def handle_requests(self):
+    for line in self.rfile:
+      try:
+        request = json.loads(line.decode('utf-8'))
+        if isinstance(self.server, AgentServer):
+          check_agent_request(request, self.server.token)
+        if request.get("forwarded") or isinstance(self.server, AgentServer):
+          # A coordinator names appliances; this agent's configuration defines them.
+          request["config"] = self.server.config_path
+          request["log-directory"] = self.server.log_directory
+        response = {"status" : "ok", "result" : execute_request(request, lambda data: self.send({"stream" : data}))}
+      except Exception as e:
+        response = {"status" : "error", "error" : str(e)}
+      self.send(response)
+
+def remove_stale_socket(socket_path):
+  if os.path.exists(socket_path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(socket_path)
+      raise RuntimeError("A lab-controller daemon is already listening on {}".format(socket_path))
+    except (ConnectionRefusedError, FileNotFoundError):
+      os.unlink(socket_path)
+    finally:
+      probe.close()
+
+def check_agent_request(request, token):
+  """Checks a request received over tcp. Paths on the agent host are not the client's to choose,
+  and optional power data must not bring host commands to run on the lab host."""
+  if not hmac.compare_digest(str(request.pop("token", "")).encode('utf-8'), token.encode('utf-8')):
+    raise RuntimeError("Invalid agent token")
+  for key in ["state-file", "capture-directory"]:
+    request.pop(key, None)
+
+  if request.get("optional-power"):
+    try:
+      json_optional = json.loads(request["optional-power"])
+    except (TypeError, ValueError):
+      raise RuntimeError("Agents only accept optional power data as serialized json")
+    for json_methods in json_optional.values():
+      for json_method in json_methods:
+        if json_method.get("type") not in ["serial", "usb"]:
+          raise RuntimeError("Agents only accept serial and usb methods in optional power data, got {}".format(
+            json_method.get("type")))
+
+class AgentServer(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+def run_daemon(socket_path, listen = None, config_path = None, log_directory = "/tmp"):
+  servers = []
+  if socket_path:
+    remove_stale_socket(socket_path)
+    servers.append(socketserver.ThreadingUnixStreamServer(socket_path, DaemonRequestHandler))
+    servers[-1].daemon_threads = True
+    print("Daemon listening on {}".format(socket_path))
+  if listen:
+    if not agent_settings.token:
+      raise RuntimeError("--listen needs LAB_CONTROLLER_AGENT_TOKEN: the agent runs commands for whoever can connect")
+    servers.append(AgentServer(parse_agent_address(listen), DaemonRequestHandler))
+    print("Agent listening on {}:{}".format(*servers[-1].server_address[:2]))
+  for server in servers:
+    server.config_path = config_path
+    server.log_directory = log_directory
+    # Only the tcp agent needs a token: the unix socket is protected by its file permissions.
+    server.token = agent_settings.token
+
+  try:
+    get_device_index().monitor()
+  except OSError as e:
+    print("Not following device hotplug events: {}".format(e))
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  for server in servers[1:]:
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+  try:
+    servers[0].serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for server in servers:
+      server.server_close()
+    if socket_path:
+      os.unlink(socket_path)
+
+def read_response(stream, output = None):
+  """Reads the response to a request, passing streamed console output to output."""
+  while True:
+    line = stream.readline()
+    if not line:
+      raise ConnectionError("connection closed without an answer")
+    message = json.loads(line.decode('utf-8'))
+    if "stream" not in message:
+      return message
+    if output is not None:
+      output(message["stream"])
+
+def echo_remote_output(data):
+  if log_settings.echo:
+    sys.stdout.write(data)
+    sys.stdout.flush()
+
+def send_request(socket_path, request):
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(socket_path)
+  except OSError as e:
+    raise RuntimeError("Cannot connect to lab-controller daemon on {}: {}".format(socket_path, e))
+
+  with client, client.makefile('rwb') as stream:
+    stream.write((json.dumps(request) + "\n").encode('utf-8'))
+    stream.flush()
+    try:
+      response = read_response(stream, echo_remote_output)
+    except ConnectionError:
+      raise RuntimeError("lab-controller daemon closed the connection without answering")
+
+  if response["status"] != "ok":
+    raise RuntimeError(response["error"])
+  return response["result"]
+
+class AgentSettings(object):
+  def __init__(self):
+    self.token = os.environ.get("LAB_CONTROLLER_AGENT_TOKEN", "")
+    self.connect_timeout = 10
+
+agent_settings = AgentSettings()
+
+def parse_agent_address(address):
+  host, _, port = address.rpartition(":")
+  if not host or not port.isdigit():
+    raise RuntimeError("Agent address must be host:port, got {}".format(address))
+  return (host, int(port))
+
+def get_appliance_host(json_appliance, run = None):
+  """The agent address of an appliance that is attached to another lab host, otherwise None."""
+  if run is not None and run.forwarded:
+    return None
+  return json_appliance.get("host")
+
+class AgentPool(object):
+  """Idle connections to lab-controller agents, reused across requests and threads."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def acquire(self, address):
+    with self.lock:
+      if self.idle.get(address):
+        return self.idle[address].pop(), True
+    try:
+      connection = socket.create_connection(parse_agent_address(address), agent_settings.connect_timeout)
+    except OSError as e:
+      raise RuntimeError("Cannot connect to lab-controller agent {}: {}".format(address, e))
+    connection.settimeout(None)
+    return (connection, connection.makefile('rwb')), False
+
+  def release(self, address, connection):
+    with self.lock:
+      self.idle.setdefault(address, []).append(connection)
+
+  def close(self):
+    with self.lock:
+      connections = [connection for connections in self.idle.values() for connection in connections]
+      self.idle = {}
+    for connection, stream in connections:
+      stream.close()
+      connection.close()
+
+  def request(self, address, request, output = None):
+    request = dict(request, token = agent_settings.token)
+    while True:
+      (connection, stream), reused = self.acquire(address)
+      answered = []
+      try:
+        stream.write((json.dumps(request) + "\n").encode('utf-8'))
+        stream.flush()
+        response = read_response(stream, lambda data: (answered.append(True), output and output(data)))
+      except (OSError, ConnectionError) as e:
+        stream.close()
+        connection.close()
+        if reused and not answered:
+          # The agent closed an idle connection, e.g. after a restart: the request never ran.
+          continue
+        raise RuntimeError("Lost lab-controller agent {}: {}".format(address, e))
+
+      self.release(address, (connection, stream))
+      if response["status"] != "ok":
+        raise RuntimeError("Agent {}: {}".format(address, response["error"]))
+      return response["result"]
+
+agent_pool = AgentPool()
+atexit.register(agent_pool.close)
+
+def do_remote_power(host, appliance, action, optional_power, run):
+  # optional_power may be a file of this host: the agent gets its content.
+  if optional_power:
+    optional_power = json.dumps(load_json_argument(optional_power))
+  request = {"command" : "power", "appliance" : appliance, "action" : action, "optional-power" : optional_power,
+    "jobs" : run.jobs, "max-per-resource" : run.max_per_resource, "rollback" : run.rollback,
+    "force" : run.force, "trust-state" : run.trust_state, "forwarded" : True}
+  with tracer.span("remote-power", host = host):
+    agent_pool.request(host, request, echo_remote_output)
 
 def main():
   json_config_path = "./config.json"
@@ -308,36 +2781,212 @@ def main():
 
   arg_mutex.add_argument("-p", "--power", choices = ['on', 'off'])
   parser.add_argument("-c", "--config", help = "Option for the path of an external configuration .json file")
-  parser.add_argument("-d", "--appliance", required=True)
+  parser.add_argument("-d", "--appliance", action = "append", default = [],
+    help = "Appliance to act on. Repeat it to act on several; in --batch mode use name=on or name=off")
   parser.add_argument("--optional-power", help = "a json file with options or serialized json")
   parser.add_argument("-l", "--log-directory", default = "/tmp", help = "The directory where logs should be stored. Default is /tmp")
+  parser.add_argument("--log-buffer-size", type = int, default = log_settings.buffer_size,
+    help = "Write buffer size in bytes of each log file. Default is 64 KiB")
+  parser.add_argument("--log-compression", choices = ["none", "gzip", "zstd"], default = "none",
+    help = "Compress log files once their command completes. zstd needs the zstandard module")
+  parser.add_argument("--no-echo", action = "store_true", default = not log_settings.echo,
+    help = "Do not echo command output to the console, only to the log files. Also set by LAB_CONTROLLER_NO_ECHO")
+  parser.add_argument("--trace", help = "Record the timing of every power and expect step in this file:"
+    " Chrome trace format when it ends in .json, json lines otherwise. A summary table is printed at the end")
+  parser.add_argument("--usb-backend", choices = ["auto", "sysfs", "uhubctl"], default = "auto",
+    help = "How usb hub ports are switched. auto uses the kernel sysfs port 'disable' attribute when it is"
+    " present and writable and falls back to uhubctl. LAB_CONTROLLER_SYSFS overrides the sysfs mount point")
+  parser.add_argument("-j", "--jobs", type = int, default = 1,
+    help = "Maximum number of group devices powered concurrently. Default is 1 (sequential)")
+  parser.add_argument("--max-per-resource", type = int, default = 1,
+    help = "Maximum concurrent operations on the same relay board serial device or usb hub. Default is 1")
+  parser.add_argument("--rollback", action = "store_true",
+    help = "Power off the group devices already powered on when a sibling fails")
+  parser.add_argument("--force", action = "store_true",
+    help = "Power the appliances even when their status probe says they already are in the requested state")
+  parser.add_argument("--trust-state", action = "store_true",
+    help = "Skip appliances whose last recorded state is the requested one when they have no status probe")
+  parser.add_argument("--state-file", default = os.path.join(get_cache_directory(), "state.json"),
+    help = "Where the last known power state of each appliance is recorded. An empty value disables it")
+  parser.add_argument("--socket", default = os.environ.get("LAB_CONTROLLER_SOCKET"),
+    help = "Unix socket of a lab-controller daemon. Requests are forwarded to it instead of executed locally,"
+    " with the log, trace, usb and lease settings of the daemon. Defaults to the LAB_CONTROLLER_SOCKET"
+    " environment variable")
+  parser.add_argument("--listen",
+    help = "With --daemon, also serve requests on host:port as an agent of this lab host. A coordinator"
+    " forwards the actions of appliances whose \"host\" is this address. LAB_CONTROLLER_AGENT_TOKEN, when set,"
+    " must match on both sides")
+  parser.add_argument("--lease", default = os.environ.get("LAB_CONTROLLER_LEASE"),
+    help = "Act as the owner of this reservation (from --reserve). Defaults to LAB_CONTROLLER_LEASE")
+  parser.add_argument("--queue-timeout", type = float,
+    help = "Give up after waiting this many seconds for appliances leased or queued by other jobs."
+    " Default is to wait")
+  parser.add_argument("--lease-directory", default = lease_settings.directory,
+    help = "Where the leases shared by all the jobs of this lab host are kept. An empty value disables"
+    " leases. Defaults to LAB_CONTROLLER_LEASE_DIR or /tmp/lab-controller-leases")
+  arg_mutex.add_argument("--reserve", type = float, metavar = "SECONDS",
+    help = "Reserve the -d appliances, their group members and the devices they use for this many seconds."
+    " Waits its turn in the lease queue and prints the lease to pass with --lease or LAB_CONTROLLER_LEASE")
+  arg_mutex.add_argument("--release", metavar = "LEASE", help = "Release a reservation")
+  parser.add_argument("--plan", action = "store_true",
+    help = "With -p, --batch or --reconcile, print the steps that would run instead of running them: the"
+    " commands, which steps run in parallel, which share a relay board or hub, and a duration estimate"
+    " from the timings of past runs")
+  arg_mutex.add_argument("--show-leases", action = "store_true", help = "Print the current leases and queue")
   arg_mutex.add_argument('--get-serial-device', choices = ['communications', 'power'])
   arg_mutex.add_argument('--json-expect-on-serial')
+  arg_mutex.add_argument("--wait-ready",
+    help = "Wait in parallel for the consoles of several appliances. Takes a json file or serialized json"
+    " mapping each appliance to its expect list and prints the time each one took to be ready")
+  parser.add_argument("--quorum", type = int,
+    help = "With --wait-ready, return as soon as this many appliances are ready. Default is all of them")
+  arg_mutex.add_argument("--batch", nargs = "?", const = "[]",
+    help = "Power many appliances in one invocation. Takes a json file or serialized json plan, either"
+    " {\"appliance\": \"on\"} or [{\"appliance\": ..., \"action\": ...}], and/or -d name=action arguments."
+    " Prints a json result per appliance")
+  arg_mutex.add_argument("--reconcile", nargs = "?", const = "[]",
+    help = "Drive a set of appliances to a target state, taking the same plan as --batch, and only power"
+    " the appliances whose status probe or recorded state differs from it")
+  arg_mutex.add_argument("--capture", action = "store_true",
+    help = "Continuously record the serial communications devices of the -d appliances (all when none is"
+    " given) in --capture-directory. --json-expect-on-serial then matches on the capture instead of the tty"
+    " and accepts a root \"from\" key: \"now\" (default), \"start\", a unix time or {\"offset\": N}")
+  parser.add_argument("--capture-directory", default = "/tmp/lab-controller-capture",
+    help = "Directory of the console captures. Default is /tmp/lab-controller-capture")
+  parser.add_argument("--segment-size", type = int, default = 8 * 1024 * 1024,
+    help = "Size in bytes after which a capture segment is rotated. Default is 8 MiB")
+  parser.add_argument("--segment-count", type = int, default = 16,
+    help = "Number of capture segments kept per device. Default is 16")
+  arg_mutex.add_argument("--validate-config", action = "store_true",
+    help = "Validate the whole configuration and report every error found")
+  arg_mutex.add_argument('--daemon', action = "store_true",
+    help = "Serve power, get-serial-device and expect-on-serial requests on --socket")
 
   args = parser.parse_args()
 
+  if args.socket and not args.daemon:
+    # These configure the process that runs the commands: with --socket, the daemon.
+    daemon_options = [option for option in ["--trace", "--no-echo", "--usb-backend", "--log-compression",
+      "--log-buffer-size", "--lease-directory"]
+      if getattr(args, option[2:].replace("-", "_")) != parser.get_default(option[2:].replace("-", "_"))]
+    if daemon_options:
+      parser.error("{} configure the daemon: pass them to lab-controller --daemon instead of with --socket".format(
+        ', '.join(daemon_options)))
+
   if args.config:
     json_config_path = args.config
 
-  if not os.path.exists(json_config_path):
-    raise RuntimeError("Selected configuration file {} not found".format(json_config_path))
+  if args.log_compression == "zstd" and zstandard is None:
+    raise RuntimeError("zstd log compression requires the zstandard python module")
+  log_settings.buffer_size = args.log_buffer_size
+  log_settings.compression = None if args.log_compression == "none" else args.log_compression
+  log_settings.echo = not args.no_echo
+  usb_settings.backend = args.usb_backend
+  lease_settings.directory = args.lease_directory
+
+  if args.trace:
+    tracer.enabled = True
+  try:
+    run_command(args, json_config_path)
+  finally:
+    if args.trace:
+      tracer.write(args.trace)
+      tracer.print_summary()
+
+def run_command(args, json_config_path):
+  if args.daemon:
+    if not args.socket and not args.listen:
+      raise RuntimeError("--daemon requires --socket, LAB_CONTROLLER_SOCKET or --listen")
+    load_config(json_config_path)
+    run_daemon(args.socket, args.listen, os.path.abspath(json_config_path), os.path.abspath(args.log_directory))
+    return
 
-  with open(json_config_path) as json_file:
-    json_conf = json.load(json_file)
+  if args.validate_config:
+    config = load_config(json_config_path, allow_errors = True)
+    for error in config.errors:
+      print(error)
+    if config.errors:
+      raise RuntimeError("{} error(s) found in {}".format(len(config.errors), json_config_path))
+    print("Configuration {} is valid: {} appliances".format(json_config_path, len(config.appliances)))
+    return
 
-  if args.power:
-    do_power(args.appliance, args.power, json_conf, args.log_directory, args.optional_power)
-  elif args.get_serial_device:
-    result_json = get_serial_device(args.appliance, args.get_serial_device, json_conf)
+  if args.capture:
+    run_capture(load_config(json_config_path), args.appliance, args.capture_directory, args.segment_size,
+      args.segment_count)
+    return
+
+  request = {"config" : os.path.abspath(json_config_path), "lease" : args.lease, "queue-timeout" : args.queue_timeout}
+  if args.release is not None:
+    request.update({"command" : "release", "lease" : args.release})
+  elif args.show_leases:
+    request.update({"command" : "leases"})
+  elif args.reserve is not None:
+    if not args.appliance:
+      raise RuntimeError("--reserve needs at least one -d/--appliance")
+    request.update({"command" : "reserve", "appliances" : args.appliance, "duration" : args.reserve})
+  else:
+    build_action_request(args, request)
+    request["dry-run"] = args.plan
+
+  if args.socket:
+    result_json = send_request(args.socket, request)
+  else:
+    result_json = execute_request(request)
+
+  if result_json is not None:
     print(json.dumps(result_json, sort_keys=True, indent=2))
+
+  if request.get("dry-run"):
+    return
+  elif request["command"] == "batch":
+    failed = [result for result in result_json if result["status"] != "ok"]
+    if failed:
+      raise RuntimeError("{} of {} batch targets failed".format(len(failed), len(result_json)))
+  elif request["command"] == "wait-ready" and result_json["ready"] < result_json["quorum"]:
+    raise RuntimeError("Only {} of {} appliances are ready".format(result_json["ready"], result_json["quorum"]))
+
+def build_action_request(args, request):
+  if args.batch is None and args.reconcile is None and args.wait_ready is None and len(args.appliance) != 1 and \
+      not (args.power and args.appliance):
+    raise RuntimeError("Exactly one -d/--appliance is required")
+
+  request["appliance"] = args.appliance[0] if args.appliance else None
+  power_options = {"optional-power" : args.optional_power, "log-directory" : os.path.abspath(args.log_directory),
+    "jobs" : args.jobs, "max-per-resource" : args.max_per_resource, "rollback" : args.rollback,
+    "force" : args.force, "trust-state" : args.trust_state or args.reconcile is not None,
+    "state-file" : os.path.abspath(args.state_file) if args.state_file else ""}
+  if args.batch is not None or args.reconcile is not None or len(args.appliance) > 1:
+    plan = args.batch if args.batch is not None else args.reconcile
+    if plan is not None:
+      targets = parse_batch_plan(load_json_argument(plan))
+      for appliance_action in args.appliance:
+        if "=" not in appliance_action:
+          raise RuntimeError("Use name=on or name=off for -d in batch mode: {}".format(appliance_action))
+        appliance, action = appliance_action.split("=", 1)
+        targets.append({"appliance" : appliance, "action" : action})
+    else:
+      targets = [{"appliance" : appliance, "action" : args.power} for appliance in args.appliance]
+    request.update(power_options)
+    request.update({"command" : "batch", "targets" : targets})
+  elif args.power:
+    request.update(power_options)
+    request.update({"command" : "power", "action" : args.power})
+  elif args.get_serial_device:
+    request.update({"command" : "get-serial-device", "section" : args.get_serial_device})
   elif args.json_expect_on_serial:
-    json_expect_on_serial = json.loads(args.json_expect_on_serial)
-    expect_on_serial(args.appliance, json_expect_on_serial, json_conf)
+    request.update({"command" : "expect-on-serial", "expect" : json.loads(args.json_expect_on_serial),
+      "capture-directory" : os.path.abspath(args.capture_directory),
+      "log-directory" : os.path.abspath(args.log_directory)})
+  elif args.wait_ready is not None:
+    request.update({"command" : "wait-ready", "plan" : load_json_argument(args.wait_ready),
+      "quorum" : args.quorum, "capture-directory" : os.path.abspath(args.capture_directory),
+      "log-directory" : os.path.abspath(args.log_directory)})
   else:
     raise ValueError("Impossible: Mandatory options not passed in arguments")
 
-try:
-  main()
-except RuntimeError as e:
-  print(e)
-  exit(1)
+if __name__ == '__main__':
+  try:
+    main()
+  except RuntimeError as e:
+    print(e)
+    exit(1)
@@ -1,23 +1,29 @@
 #!/usr/bin/env python3
 
 import subprocess
-import io
 import os
 import sys
 import stat
 import shutil
 import time
 import argparse
+import socket
+import struct
+import errno
+import ipaddress
+import select
+import fnmatch
 
 
 def runProcess(command):
     process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
+    # communicate reads both pipes while waiting, a child filling a pipe cannot block.
+    stdout, stderr = process.communicate()
     print(command)
     return {"ret": process.returncode,
         "command": command,
-        "stdout": io.TextIOWrapper(process.stdout, encoding='utf-8').readlines(),
-        "stderr" : io.TextIOWrapper(process.stderr, encoding='utf-8').readlines()}
+        "stdout": stdout.decode('utf-8').splitlines(True),
+        "stderr" : stderr.decode('utf-8').splitlines(True)}
 
 def isZeroExitCode(process):
     return True if process["ret"] == 0 else False
@@ -25,36 +31,28 @@ def isZeroExitCode(process):
 def doesCommandExist(command):
     return shutil.which(command)
 
-def doesNMInterfaceExist(interface):
-    result = runProcess("nmcli device status")
+def getNMDeviceStates():
+    result = runProcess("nmcli -t -f DEVICE,STATE device status")
     if not isZeroExitCode(result):
         raise Exception("nmcli should not fail when checking global status. Error:\n{}".format(result["stderr"]))
 
+    states = {}
     for line in result["stdout"]:
-        if interface in line:
-            return True
-    return False
-
-def isNMInterfaceManaged(interface):
-    if not doesNMInterfaceExist(interface):
-        raise Exception("Network Manager Interface {} does not exist".format(interface))
-
-    result = runProcess("nmcli device show {}".format(interface))
-    if not isZeroExitCode(result):
-        raise Exception("nmcli device show {} failed with error:\n{}".format(interface, result["stderr"]))
-
-    for line in result["stdout"]:
-        if "GENERAL.STATE:" in line:
-            if "unmanaged" in line:
-                return False
-            else:
-                return True
-
-    raise Exception("Could not find the General state of the interface {}".format(interface))
-
-def doesIPInterfaceExist(interface):
-    res = runProcess("ip link show {}".format(interface))
-    return isZeroExitCode(res)
+        device, _, state = line.strip().rpartition(":")
+        states[device.replace("\\:", ":")] = state
+    return states
+
+def checkNMUnmanaged(interfaces):
+    if not doesCommandExist("nmcli"):
+        return
+
+    states = getNMDeviceStates()
+    for interface in interfaces:
+        if interface not in states:
+            raise Exception("Network Manager Interface {} does not exist".format(interface))
+        if states[interface] != "unmanaged":
+            raise Exception("Interface {} is managed by network manager and we cannot work with that, \
+                as we do not want to touch user leve stuff".format(interface))
 
 def isIPInterfaceUp(interface):
     res = runProcess("ip link show {}".format(interface))
@@ -97,6 +95,189 @@ def configureIPInterface(interface, ip, broadcast_ip=None):
         raise Exception("Error configuring interface {}. Error thrown in ip\n{}\n{}".format(
             interface, cmd_string, res["stderr"]))
 
+NLMSG_HEADER = struct.Struct("=LHHLL")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTMSG = struct.Struct("=BBBBBBBBI")
+RTATTR = struct.Struct("=HH")
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_CREATE = 0x400
+NLM_F_EXCL = 0x200
+
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_GETROUTE = 26
+
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_BROADCAST = 4
+RTA_DST = 1
+RTA_OIF = 4
+RTA_TABLE = 15
+
+RTMGRP_LINK = 0x1
+
+IFF_UP = 0x1
+RT_TABLE_MAIN = 254
+OPERSTATES = ["UNKNOWN", "NOTPRESENT", "DOWN", "LOWERLAYERDOWN", "TESTING", "DORMANT", "UP"]
+
+def alignNetlink(length):
+    return (length + 3) & ~3
+
+def packAttribute(attribute_type, data):
+    return RTATTR.pack(RTATTR.size + len(data), attribute_type) + data + b'\0' * (alignNetlink(len(data)) - len(data))
+
+def unpackAttributes(data):
+    attributes = {}
+    offset = 0
+    while offset + RTATTR.size <= len(data):
+        length, attribute_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attributes[attribute_type] = data[offset + RTATTR.size:offset + length]
+        offset += alignNetlink(length)
+    return attributes
+
+class RouteNetlink(object):
+    """Minimal rtnetlink client: dumps links, addresses and routes and changes them
+    without running a process per query."""
+    def __init__(self, groups = 0):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.socket.bind((0, groups))
+        self.sequence = int(time.time())
+        self.notified = False
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def packMessage(self, message_type, flags, payload):
+        self.sequence += 1
+        return NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), message_type, flags, self.sequence, 0) + payload
+
+    def receive(self, sequences):
+        """Collects the replies to the given sequence numbers until each is done or acknowledged."""
+        replies = []
+        pending = set(sequences)
+        while pending:
+            data = self.socket.recv(65536)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, message_type, flags, sequence, pid = NLMSG_HEADER.unpack_from(data, offset)
+                body = data[offset + NLMSG_HEADER.size:offset + length]
+                offset += alignNetlink(length)
+                if sequence == 0:
+                    # A multicast notification of the subscribed groups, e.g. a link appearing.
+                    self.notified = True
+                    continue
+                if sequence not in pending:
+                    continue
+                if message_type == NLMSG_DONE:
+                    pending.discard(sequence)
+                elif message_type == NLMSG_ERROR:
+                    pending.discard(sequence)
+                    error = -struct.unpack_from("=i", body)[0]
+                    if error != 0:
+                        raise OSError(error, "netlink request failed: {}".format(os.strerror(error)))
+                else:
+                    replies.append((message_type, body))
+        return replies
+
+    def dump(self, message_type, payload):
+        message = self.packMessage(message_type, NLM_F_REQUEST | NLM_F_DUMP, payload)
+        self.socket.send(message)
+        return self.receive([self.sequence])
+
+    def apply(self, messages):
+        """Sends a batch of (type, flags, payload) changes in one datagram and waits for all of them."""
+        data = b''
+        sequences = []
+        for message_type, flags, payload in messages:
+            data += self.packMessage(message_type, NLM_F_REQUEST | NLM_F_ACK | flags, payload)
+            sequences.append(self.sequence)
+        if data:
+            self.socket.send(data)
+            self.receive(sequences)
+
+    def getLinks(self):
+        links = {}
+        for message_type, body in self.dump(RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+            family, link_type, index, flags, change = IFINFOMSG.unpack_from(body)
+            attributes = unpackAttributes(body[IFINFOMSG.size:])
+            name = attributes[IFLA_IFNAME].rstrip(b'\0').decode()
+            operstate = attributes.get(IFLA_OPERSTATE, b'\0')[0]
+            links[name] = {"index": index, "up": (flags & IFF_UP) != 0,
+                "state": OPERSTATES[operstate] if operstate < len(OPERSTATES) else "UNKNOWN"}
+        return links
+
+    def getAddresses(self):
+        addresses = {}
+        for message_type, body in self.dump(RTM_GETADDR, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+            family, prefix_length, flags, scope, index = IFADDRMSG.unpack_from(body)
+            attributes = unpackAttributes(body[IFADDRMSG.size:])
+            address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+            if address is not None:
+                addresses.setdefault(index, []).append({"family": family, "prefix": prefix_length,
+                    "scope": scope, "address": address})
+        return addresses
+
+    def getDefaultRouteIndex(self):
+        for message_type, body in self.dump(RTM_GETROUTE, RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)):
+            family, dst_length, src_length, tos, table, protocol, scope, route_type, flags = RTMSG.unpack_from(body)
+            attributes = unpackAttributes(body[RTMSG.size:])
+            if RTA_TABLE in attributes:
+                table = struct.unpack("=I", attributes[RTA_TABLE])[0]
+            if dst_length == 0 and table == RT_TABLE_MAIN and RTA_OIF in attributes:
+                return struct.unpack("=i", attributes[RTA_OIF])[0]
+        return None
+
+    def getState(self):
+        """Links, addresses and the default route device index, one dump each over the same socket."""
+        return {"links": self.getLinks(), "addresses": self.getAddresses(),
+            "default-route": self.getDefaultRouteIndex()}
+
+    def waitForNotification(self, timeout):
+        """Waits until the kernel sends a notification of the subscribed groups."""
+        readable, _, _ = select.select([self.socket], [], [], max(0, timeout))
+        if not readable:
+            return False
+        while True:
+            try:
+                self.socket.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return True
+
+    def getLinkUpMessage(self, index, up):
+        return (RTM_NEWLINK, 0, IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, IFF_UP if up else 0, IFF_UP))
+
+    def getFlushMessages(self, index, addresses):
+        return [(RTM_DELADDR, 0, IFADDRMSG.pack(address["family"], address["prefix"], 0, address["scope"], index) +
+            packAttribute(IFA_LOCAL, address["address"])) for address in addresses.get(index, [])]
+
+    def getAddAddressMessage(self, index, ip, broadcast_ip = None):
+        interface = ipaddress.ip_interface(ip)
+        family = socket.AF_INET if interface.version == 4 else socket.AF_INET6
+        payload = IFADDRMSG.pack(family, interface.network.prefixlen, 0, 0, index)
+        payload += packAttribute(IFA_LOCAL, interface.ip.packed) + packAttribute(IFA_ADDRESS, interface.ip.packed)
+        if broadcast_ip:
+            payload += packAttribute(IFA_BROADCAST, ipaddress.ip_address(broadcast_ip).packed)
+        return (RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, payload)
+
 def isAcceptablePythonVersion(major, minor):
     return sys.version_info[0] == major and sys.version_info[1] > minor
 
@@ -108,7 +289,13 @@ def doesCommandHaveSUID(command):
 def doesIPHaveSUID():
     return doesCommandHaveSUID('ip')
 
+IP_FORWARD_PATH = "/proc/sys/net/ipv4/ip_forward"
+
 def isIPV4ForwardingEnabled():
+    if os.path.exists(IP_FORWARD_PATH):
+        with open(IP_FORWARD_PATH) as ip_forward:
+            return ip_forward.read().strip() == "1"
+
     res = runProcess('sysctl net.ipv4.ip_forward')
     if not isZeroExitCode(res):
         raise Exception("Could not run sysctl?. {} Error:\n{}".format(
@@ -127,12 +314,19 @@ def isIPV4ForwardingEnabled():
 
 def setSYSCTLIPV4Forwarding():
     if not isIPV4ForwardingEnabled():
+        try:
+            with open(IP_FORWARD_PATH, 'w') as ip_forward:
+                ip_forward.write("1")
+            return
+        except OSError:
+            pass
+
         if not doesCommandHaveSUID('sysctl'):
             raise Exception(
                 "Could not turn on ipv4 forwarding. Please set suid in sysctl \
                     or add net.ipv4.ip_forward = 1 to /etc/sysctl.conf")
         else:
-            if not isZeroExitCode("sysctl -w net.ipv4.ip_forward = 1"):
+            if not isZeroExitCode(runProcess("sysctl -w net.ipv4.ip_forward=1")):
                 raise Exception("Failed to set ipv4 forwarding on")
 
 def getGatewayDevice():
@@ -151,69 +345,184 @@ def getGatewayDevice():
     
     raise Exception("Could not find default gateway device")
 
-def setIPTablesNat():
-    gw_interface = getGatewayDevice()
-    res = runProcess("iptables -t nat -A POSTROUTING -o {} -j MASQUERADE".format(gw_interface))
+def setIPTablesNat(gw_interface = None):
+    if gw_interface is None:
+        gw_interface = getGatewayDevice()
+    rule = "-t nat {} POSTROUTING -o {} -j MASQUERADE"
+    if isZeroExitCode(runProcess("iptables " + rule.format("-C", gw_interface))):
+        return
+    res = runProcess("iptables " + rule.format("-A", gw_interface))
     if not isZeroExitCode(res):
         raise Exception("Could not set iptables forwarding NAT. Command\n{}\n{}".format(res["command"], res["stderr"]))
 
-def configureInterfaceUp(args):
-    if doesCommandExist("nmcli"):
-        if isNMInterfaceManaged(args.interface):
-            raise Exception("Interface {} is managed by network manager and we cannot work with that, \
-                as we do not want to touch user leve stuff")
-    attempts=0
-    while attempts <= 3:
-        if doesIPInterfaceExist(args.interface):
-            if not isIPInterfaceUp(args.interface):
-                bringIPInterfaceUp(args.interface)
-
-
-            flushIPInterface(args.interface)
-            configureIPInterface(args.interface, args.ip, args.broadcast_ip)
-            setSYSCTLIPV4Forwarding()
-            setIPTablesNat()
+SYS_CLASS_NET = "/sys/class/net"
+KERNELS_PREFIX = "kernels="
+
+def getInterfaceAddresses(args):
+    ips = args.ip.split(",") if args.ip else []
+    if len(ips) != len(args.interfaces):
+        raise Exception("Give one ip per interface: {} interfaces and {} ips".format(len(args.interfaces), len(ips)))
+    broadcast_ips = args.broadcast_ip.split(",") if args.broadcast_ip else [None] * len(ips)
+    if len(broadcast_ips) != len(ips):
+        raise Exception("Give one broadcast ip per interface")
+    return dict(zip(args.interfaces, zip(ips, broadcast_ips)))
+
+def resolveInterface(interface, links):
+    """An interface is a name or kernels=PATTERN, matched like udev KERNELS against the usb
+    path of the device, e.g. kernels=1-2.3.1:1.0."""
+    if not interface.startswith(KERNELS_PREFIX):
+        return interface if interface in links else None
+
+    pattern = interface[len(KERNELS_PREFIX):]
+    for name in sorted(links.keys()):
+        device_link = os.path.join(SYS_CLASS_NET, name, "device")
+        if not os.path.exists(device_link):
+            continue
+        device_path = os.path.realpath(device_link)
+        if any(fnmatch.fnmatchcase(component, pattern) for component in device_path.split("/")):
+            return name
+    return None
+
+def waitForInterfaces(netlink, interfaces, timeout, onAppear):
+    """Calls onAppear(state, {interface: name}) as soon as some of the interfaces exist, until all
+    of them were seen. The netlink socket must be subscribed to link notifications."""
+    deadline = time.time() + timeout
+    pending = list(interfaces)
+    while True:
+        netlink.notified = False
+        state = netlink.getState()
+        appeared = {}
+        for interface in pending:
+            name = resolveInterface(interface, state["links"])
+            if name is not None:
+                appeared[interface] = name
+        if appeared:
+            onAppear(state, appeared)
+            pending = [interface for interface in pending if interface not in appeared]
+        if not pending:
+            return state
+        if netlink.notified:
+            continue
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Exception("IP Interface does not exist: {}".format(", ".join(pending)))
+        print("Waiting up to {:.1f}s for {}".format(remaining, ", ".join(pending)))
+        netlink.waitForNotification(remaining)
+
+def configureInterfacesNetlink(netlink, state, interface_addresses):
+    messages = []
+    for name, (ip, broadcast_ip) in interface_addresses:
+        index = state["links"][name]["index"]
+        if not state["links"][name]["up"]:
+            messages.append(netlink.getLinkUpMessage(index, True))
+        messages += netlink.getFlushMessages(index, state["addresses"])
+        messages.append(netlink.getAddAddressMessage(index, ip, broadcast_ip))
+    netlink.apply(messages)
+
+def configureInterfacesIP(interface_addresses):
+    checkIPCommand()
+    for name, (ip, broadcast_ip) in interface_addresses:
+        if not isIPInterfaceUp(name):
+            bringIPInterfaceUp(name)
+        flushIPInterface(name)
+        configureIPInterface(name, ip, broadcast_ip)
+
+def configureInterfacesDownNetlink(netlink, state, names):
+    messages = []
+    for name in names:
+        index = state["links"][name]["index"]
+        # Flush first: taking the link down already drops some addresses, e.g. ipv6 link local.
+        messages += netlink.getFlushMessages(index, state["addresses"])
+        messages.append(netlink.getLinkUpMessage(index, False))
+    netlink.apply(messages)
+
+def checkIPCommand():
+    if not doesCommandExist("ip"):
+        raise Exception("To configure the interfaces the ip command must exist, which is not the case")
+
+    if not doesIPHaveSUID():
+        raise Exception("We need suid for ip to bring interfaces up. Try chmod u+s /bin/ip")
+
+def isNetlinkPermissionError(error):
+    return error.errno in [errno.EPERM, errno.EACCES]
+
+def applyWithBackend(args, netlinkChange, ipChange):
+    if args.backend != "ip":
+        try:
+            netlinkChange()
             return
-        else:
-            attempts += 1
-            print("trying again attempt {}/3".format(attempts))
-            time.sleep(2)
+        except OSError as error:
+            if args.backend == "netlink" or not isNetlinkPermissionError(error):
+                raise
+            print("Netlink changes are not permitted, falling back to ip: {}".format(error))
+            args.backend = "ip"
+    ipChange()
+
+def configureInterfaceUp(args):
+    addresses = getInterfaceAddresses(args)
+
+    def onAppear(state, appeared):
+        checkNMUnmanaged(appeared.values())
+        interface_addresses = [(name, addresses[interface]) for interface, name in appeared.items()]
+        print("Configuring {}".format(", ".join(appeared.values())))
+        applyWithBackend(args, lambda: configureInterfacesNetlink(netlink, state, interface_addresses),
+            lambda: configureInterfacesIP(interface_addresses))
+
+    # Subscribe before the first dump so a link appearing in between is not missed.
+    with RouteNetlink(RTMGRP_LINK) as netlink:
+        state = waitForInterfaces(netlink, args.interfaces, args.timeout, onAppear)
+
+    links_by_index = {link["index"]: name for name, link in state["links"].items()}
+    if state["default-route"] not in links_by_index:
+        raise Exception("Could get gateway because there seems to not"
+            "be any gateway device connected to the internet.")
 
-    raise Exception("IP Interface does not exist")
+    setSYSCTLIPV4Forwarding()
+    setIPTablesNat(links_by_index[state["default-route"]])
 
 def configureInterfaceDown(args):
     print(args)
-    if doesCommandExist("nmcli"):
-        if isNMInterfaceManaged(args.interface):
-            raise Exception("Interface {} is managed by network manager and we cannot work with that, \
-                as we do not want to touch user leve stuff ")
-    
-    if doesIPInterfaceExist(args.interface):
-        bringIPInterfaceDown(args.interface)
-        flushIPInterface(args.interface)
+    with RouteNetlink() as netlink:
+        state = netlink.getState()
+        names = [name for name in (resolveInterface(interface, state["links"]) for interface in args.interfaces)
+            if name is not None]
+        checkNMUnmanaged(names)
+
+        def ipChange():
+            checkIPCommand()
+            for name in names:
+                bringIPInterfaceDown(name)
+                flushIPInterface(name)
+
+        applyWithBackend(args, lambda: configureInterfacesDownNetlink(netlink, state, names), ipChange)
 
 if __name__ == '__main__':
     #shutil.which
     if not isAcceptablePythonVersion(3, 3):
         raise Exception("We need at least Python 3.3")
 
-    if not doesIPHaveSUID():
-        raise Exception("We need suid for ip to bring interfaces up. Try chmod u+s /bin/ip")
-
-
-    if not doesCommandExist("ip"):
-        raise Exception("To configure the interfaces the ip command must exist, which is not the case")
-
     parser = argparse.ArgumentParser(description="A program to setup interfaces of boards.")
-    parser.add_argument('interface', nargs='?', help="The interface name to setup.")
+    parser.add_argument('interface', nargs='?',
+        help="The interface name to setup, or kernels=PATTERN to match the usb path of the device as udev"
+        " KERNELS does. Several interfaces can be given separated by commas.")
+    parser.add_argument('--backend', choices=['auto', 'netlink', 'ip'], default='auto',
+        help="auto uses netlink and falls back to the ip command when netlink changes are not permitted.")
+    parser.add_argument('--timeout', type=float, default=6,
+        help="Seconds to wait for the interfaces to appear, e.g. while the boards power up.")
     subparsers = parser.add_subparsers(help='Bring up or down')
     parser_up = subparsers.add_parser('up', help = "Options to bring interface up")
-    parser_up.add_argument('ip', nargs='?', help="The ip address for the interface to setup.")
-    parser_up.add_argument('broadcast_ip', nargs='?', help="The broadcast ip for the interface to setup.")
+    parser_up.add_argument('ip', nargs='?',
+        help="The ip address for the interface to setup. One per interface, separated by commas.")
+    parser_up.add_argument('broadcast_ip', nargs='?',
+        help="The broadcast ip for the interface to setup. One per interface, separated by commas.")
     parser_up.set_defaults(func=configureInterfaceUp)
 
     parser_down = subparsers.add_parser('down', help="Bring it down")
     parser_down.set_defaults(func=configureInterfaceDown)
 
     args = parser.parse_args()
+    if not args.interface:
+        parser.error("an interface is required")
+    args.interfaces = [interface for interface in args.interface.split(",") if interface]
     args.func(args)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Checks the device index against a fake sysfs tree built under LAB_CONTROLLER_SYSFS: a hub
+# with a usb serial adapter behind it, which is then swapped for another adapter at the same
+# path, and a second adapter plugged in and out through uevents. Also checks the lookup of
+# the hub port directories.
+import os
+import importlib.util
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sysfs_root = os.environ["LAB_CONTROLLER_SYSFS"]
+
+def load_lab_controller():
+  spec = importlib.util.spec_from_file_location("lab_controller", os.path.join(this_dir, "..", "lab-controller.py"))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def write_attributes(usb_path, vendor, product, serial, device_class = "00"):
+  for name, value in [("idVendor", vendor), ("idProduct", product), ("serial", serial), ("bDeviceClass", device_class)]:
+    with open(os.path.join(usb_path, name), 'w') as attribute:
+      attribute.write(value + "\n")
+
+def add_usb_device(kernels, vendor, product, serial, device_class = "00"):
+  usb_path = os.path.join(sysfs_root, "devices", "pci0000:00", "usb1", *kernels.split("/"))
+  os.makedirs(usb_path)
+  write_attributes(usb_path, vendor, product, serial, device_class)
+  bus_directory = os.path.join(sysfs_root, "bus", "usb", "devices")
+  os.makedirs(bus_directory, exist_ok = True)
+  os.symlink(usb_path, os.path.join(bus_directory, os.path.basename(usb_path)))
+  return usb_path
+
+def add_tty(usb_path, name):
+  port_path = os.path.join(usb_path, os.path.basename(usb_path) + ":1.0", name)
+  tty_path = os.path.join(port_path, "tty", name)
+  os.makedirs(tty_path)
+  os.symlink(port_path, os.path.join(tty_path, "device"))
+  class_directory = os.path.join(sysfs_root, "class", "tty")
+  os.makedirs(class_directory, exist_ok = True)
+  os.symlink(tty_path, os.path.join(class_directory, name))
+  return tty_path
+
+def uevent(action, subsystem, path):
+  devpath = "/" + os.path.relpath(path, sysfs_root)
+  return "{}@{}\0ACTION={}\0DEVPATH={}\0SUBSYSTEM={}\0".format(action, devpath, action, devpath, subsystem).encode()
+
+def expect_error(function, *args):
+  try:
+    function(*args)
+  except RuntimeError:
+    return
+  raise AssertionError("{}{} did not fail".format(function.__name__, args))
+
+lab_controller = load_lab_controller()
+hub_path = add_usb_device("1-2", "2109", "2817", "HUB1", "09")
+adapter_path = add_usb_device("1-2/1-2.3", "0403", "6001", "A1")
+add_tty(adapter_path, "ttyUSB0")
+
+index = lab_controller.get_device_index()
+index.scan()
+assert index.lookup("tty", {"serial" : "A1"}) == "/dev/ttyUSB0"
+assert index.lookup("tty", {"vendor" : "0403", "kernels" : "1-2.3"}) == "/dev/ttyUSB0"
+assert index.lookup("hub", {"vendor" : "2109"}) == "1-2"
+expect_error(index.lookup, "tty", {"serial" : "missing"})
+
+# A fresh index starts from the cache written by the scan.
+index = lab_controller.DeviceIndex(sysfs_root, index.cache_path)
+assert index.load()
+assert index.find("tty", {"serial" : "A1"})[0]["node"] == "/dev/ttyUSB0"
+
+# Another adapter enumerated at the same path while nobody watched: the cached entry still
+# names a path that exists, but it is no longer the adapter that was asked for.
+write_attributes(adapter_path, "0403", "6001", "B2")
+expect_error(index.lookup, "tty", {"serial" : "A1"})
+assert index.lookup("tty", {"serial" : "B2"}) == "/dev/ttyUSB0"
+
+second_path = add_usb_device("1-2/1-2.4", "067b", "2303", "C3")
+second_tty = add_tty(second_path, "ttyUSB1")
+index.handle_uevent(uevent("add", "usb", second_path))
+index.handle_uevent(uevent("add", "tty", second_tty))
+assert [entry["node"] for entry in index.find("tty", {"serial" : "C3"})] == ["/dev/ttyUSB1"]
+assert [entry["node"] for entry in index.find("tty", {"kernels" : "1-2"})] == ["/dev/ttyUSB0", "/dev/ttyUSB1"]
+
+index.handle_uevent(uevent("remove", "usb", second_path))
+assert index.find("tty", {"serial" : "C3"}) == []
+assert [entry["node"] for entry in index.find("tty", {"kernels" : "1-2"})] == ["/dev/ttyUSB0"]
+assert lab_controller.DeviceIndex(sysfs_root, index.cache_path).load()
+
+# The hub ports only show up once the hub driver is bound: a miss must not stick.
+assert lab_controller.get_usb_port_path("1-2", 4) is None
+port_path = os.path.join(hub_path, "1-2:1.0", "1-2-port4")
+os.makedirs(port_path)
+os.symlink(os.path.dirname(port_path), os.path.join(sysfs_root, "bus", "usb", "devices", "1-2:1.0"))
+open(os.path.join(port_path, "disable"), 'w').close()
+assert lab_controller.get_usb_port_path("1-2", 4) == os.path.join(sysfs_root, "bus", "usb", "devices", "1-2:1.0", "1-2-port4")
+print("Device index ok")
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# Fakes the serial console of a board: writes a configuration with a "pty-board" appliance
+# whose console is a pty, prints a login prompt on it after a delay and keeps it open.
+import os
+import pty
+import sys
+import time
+import tty
+import json
+
+config_path = sys.argv[1]
+delay = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+master, slave = pty.openpty()
+tty.setraw(master)
+config = {"pty-board" : {"power" : [{"type" : "host", "command" : {"on" : [{"execute" : "true"}]}}],
+  "communications" : [{"type" : "serial", "baud" : "115200", "device" : os.ttyname(slave)}]}}
+with open(config_path + ".tmp", "w") as config_file:
+  json.dump(config, config_file)
+os.replace(config_path + ".tmp", config_path)
+
+time.sleep(delay)
+os.write(master, b"booting\r\nlogin: \r\n")
+time.sleep(10)
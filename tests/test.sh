@@ -7,4 +7,134 @@ rm -f $this_dir/lab-controller-*.log
 find $this_dir/lab-controller-*.log
 rm -f $this_dir/lab-controller-*.log
 
+trace_file="$(mktemp /tmp/lab-controller-trace-XXXXXX.json)"
+"$this_dir"/../lab-controller.py -l $this_dir/ -d group-test -c "$this_dir"/group-log.json -p on -j 4 \
+  --trace "$trace_file" | grep "Stage 2/2 \[after-a\]"
+grep -q '"traceEvents"' "$trace_file"
+rm -f "$trace_file"
+"$this_dir"/../lab-controller.py -l $this_dir/ -d group-test -c "$this_dir"/group-log.json -p on -j 4 --plan \
+  | grep -A1 '"levels"' | grep -q '\['
+! "$this_dir"/../lab-controller.py -l $this_dir/ -d failing-group-test -c "$this_dir"/group-log.json -p on -j 4 --rollback
+for jobs in 1 2; do
+  ! "$this_dir"/../lab-controller.py -l $this_dir/ -d rollback-group -c "$this_dir"/group-log.json -p on -j $jobs \
+    --rollback --state-file ""
+  [ ! -e /tmp/lab-controller-test-rollback-a ] && [ ! -e /tmp/lab-controller-test-rollback-c ]
+done
+rm -f $this_dir/lab-controller-*.log
+
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --batch -d sleeper-a=on -d sleeper-b=off -j 2 \
+  | grep -c '"status": "ok"' | grep -q 2
+! "$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --batch -d sleeper-a=on -d failing=on
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --reconcile -d probed-on=on \
+  --state-file "" | grep -A1 '"unchanged"' | grep -q probed-on
+! "$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json -d probed-on -p on --force --state-file ""
+"$this_dir"/../lab-controller.py -l $this_dir/ -d parallel-sleepers -c "$this_dir"/group-log.json -p on --state-file ""
+! "$this_dir"/../lab-controller.py -l $this_dir/ -d parallel-sleepers -c "$this_dir"/group-log.json -p off --state-file ""
+start=$SECONDS
+! "$this_dir"/../lab-controller.py -l $this_dir/ -d panicking -c "$this_dir"/group-log.json -p on --state-file ""
+[ $((SECONDS - start)) -lt 10 ]
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --batch -d flaky=on --state-file "" \
+  | grep -A1 '"retries"' | grep -q ': 1'
+lease_directory="$(mktemp -d /tmp/lab-controller-leases-XXXXXX)"
+lease="$("$this_dir"/../lab-controller.py -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d sleeper-a --reserve 60 | sed -n 's/.*"lease": "\(.*\)".*/\1/p')"
+! "$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d group-test -p off --queue-timeout 0.5 --state-file ""
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d sleeper-a -p off --queue-timeout 20 --state-file "" &
+waiter_pid=$!
+until "$this_dir"/../lab-controller.py -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  --show-leases | grep -q '"ticket"'; do sleep 0.1; done
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d sleeper-a -p off --lease "$lease" --queue-timeout 0.5 --state-file ""
+"$this_dir"/../lab-controller.py -c "$this_dir"/group-log.json --lease-directory "$lease_directory" --release "$lease"
+wait $waiter_pid
+lease="$("$this_dir"/../lab-controller.py -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d sleeper-a --reserve 60 | sed -n 's/.*"lease": "\(.*\)".*/\1/p')"
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d group-test -p off --queue-timeout 20 --state-file "" &
+waiter_pid=$!
+until "$this_dir"/../lab-controller.py -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  --show-leases | grep -q '"ticket"'; do sleep 0.1; done
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d group-test -p off --lease "$lease" --queue-timeout 5 --state-file ""
+"$this_dir"/../lab-controller.py -c "$this_dir"/group-log.json --lease-directory "$lease_directory" --release "$lease"
+wait $waiter_pid
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --lease-directory "$lease_directory" \
+  -d group-test -p off --queue-timeout 0.5 --state-file ""
+rm -rf "$lease_directory"
+rm -f $this_dir/lab-controller-*.log
+
+sysfs_directory="$(mktemp -d /tmp/lab-controller-sysfs-XXXXXX)"
+cache_directory="$(mktemp -d /tmp/lab-controller-cache-XXXXXX)"
+LAB_CONTROLLER_SYSFS="$sysfs_directory" LAB_CONTROLLER_CACHE_DIR="$cache_directory" python3 "$this_dir"/device-index.py
+rm -rf "$sysfs_directory" "$cache_directory"
+
+board_config="$(mktemp -u /tmp/lab-controller-board-XXXXXX.json)"
+python3 "$this_dir"/pty-board.py "$board_config" 1 &
+board_pid=$!
+while [ ! -s "$board_config" ]; do sleep 0.1; done
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$board_config" \
+  --wait-ready '{"pty-board": [{"text": "booting.*login:", "timeout": 5}]}' | grep -q '"ready": 1'
+kill $board_pid
+rm -f "$board_config"
+
+capture_directory="$(mktemp -d /tmp/lab-controller-capture-XXXXXX)"
+python3 "$this_dir"/pty-board.py "$board_config" 3 &
+board_pid=$!
+while [ ! -s "$board_config" ]; do sleep 0.1; done
+"$this_dir"/../lab-controller.py -c "$board_config" --capture --capture-directory "$capture_directory" &
+capture_pid=$!
+trap "kill $capture_pid $board_pid" EXIT
+while [ ! -e "$capture_directory"/*/capture.lock ]; do sleep 0.1; done
+expect_pids=""
+for waiter in 1 2; do
+  "$this_dir"/../lab-controller.py -l $this_dir/ -c "$board_config" --capture-directory "$capture_directory" \
+    -d pty-board --json-expect-on-serial '{"expect": [{"text": "login:", "timeout": 8}]}' &
+  expect_pids="$expect_pids $!"
+done
+for expect_pid in $expect_pids; do wait $expect_pid; done
+kill $capture_pid $board_pid
+trap - EXIT
+rm -rf "$capture_directory" "$board_config"
+rm -f $this_dir/lab-controller-*.log
+
+socket_path="$(mktemp -u /tmp/lab-controller-test-XXXXXX.sock)"
+"$this_dir"/../lab-controller.py --daemon --socket "$socket_path" &
+daemon_pid=$!
+trap "kill $daemon_pid" EXIT
+while [ ! -S "$socket_path" ]; do sleep 0.1; done
+"$this_dir"/../lab-controller.py --socket "$socket_path" -l $this_dir/ -d stderr-test -c "$this_dir"/stderr-log.json -p on
+
+agent_a="127.0.0.1:$((20000 + RANDOM % 20000))"
+! LAB_CONTROLLER_AGENT_TOKEN= "$this_dir"/../lab-controller.py -c "$this_dir"/group-log.json --daemon --listen "$agent_a"
+export LAB_CONTROLLER_AGENT_TOKEN="$(head -c 16 /dev/urandom | od -An -tx1 | tr -d ' \n')"
+agent_b="${agent_a%:*}:$((${agent_a#*:} + 1))"
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --daemon --listen "$agent_a" &
+agent_a_pid=$!
+"$this_dir"/../lab-controller.py -l $this_dir/ -c "$this_dir"/group-log.json --daemon --listen "$agent_b" &
+agent_b_pid=$!
+trap "kill $daemon_pid $agent_a_pid $agent_b_pid" EXIT
+coordinator_config="$(mktemp /tmp/lab-controller-coordinator-XXXXXX.json)"
+cat > "$coordinator_config" <<EOF
+{
+  "federated-group" : { "power" : [ { "type" : "group", "devices" : [ "sleeper-a", "sleeper-b" ] } ] },
+  "sleeper-a" : { "host" : "$agent_a" },
+  "sleeper-b" : { "host" : "$agent_b" },
+  "failing" : { "host" : "$agent_b" }
+}
+EOF
+for agent in "$agent_a" "$agent_b"; do
+  until (echo > /dev/tcp/${agent%:*}/${agent#*:}) 2>/dev/null; do sleep 0.1; done
+done
+optional_power="$(mktemp /tmp/lab-controller-optional-XXXXXX.json)"
+echo '{ "sleeper-a-extra" : [] }' > "$optional_power"
+"$this_dir"/../lab-controller.py -l $this_dir/ -d federated-group -c "$coordinator_config" -p on -j 2 --state-file "" \
+  --optional-power "$optional_power"
+rm -f "$optional_power"
+! "$this_dir"/../lab-controller.py -l $this_dir/ -d failing -c "$coordinator_config" -p on --state-file ""
+rm -f "$coordinator_config"
+find $this_dir/lab-controller-*.log
+rm -f $this_dir/lab-controller-*.log
+
 echo Success
\ No newline at end of file